@@ -1,3 +1,4 @@
+# -*- coding: latin-1 -*-
 #
 # CSV 0.17  8 June 1999    Copyright Laurence Tratt 1998 - 1999
 # e-mail: tratt@dcs.kcl.ac.uk
@@ -32,7 +33,13 @@
 # 6/16/00 - skip@mojam.com - fixed output of titles to avoid blank line
 # ???     - skip@mojam.com - pulled line__make out of output method
 
-import re, string, types, UserList
+import re, string, types, UserList, StringIO, array, itertools
+import multiprocessing, marshal, gc, tempfile, heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ####################################################################################
@@ -41,6 +48,10 @@ import re, string, types, UserList
 #
 
 
+# a quoted string (whose contents are group 1) or a run of unquoted text
+quote_regex = re.compile(r'"((?:[^"]|"")*)"?|[^"]+')
+
+
 class CSV(UserList.UserList):
 
     """ Manage a CSV (comma separated values) file
@@ -50,6 +61,8 @@ class CSV(UserList.UserList):
     Methods:
         __init__()
         load()    load from file
+        iter_rows() generate entries from a file without loading it
+        load_parallel() load from file, parsing it in several processes
         save()    save to file
         input()   input from string
         output()  save to string
@@ -70,6 +83,8 @@ class CSV(UserList.UserList):
         self.separator = separator
 
         self.data = []
+        # separator -> match function of its field regular expression
+        self.field_regexes = {}
         self.fields_title_have = self.fields_title = None
 
 
@@ -134,123 +149,460 @@ class CSV(UserList.UserList):
                                             to remove comments (defaults to ['#'])
         """
 
-        def line_process(line, convert_numbers, separator):
+        separator = separator or self.separator
+        comments = comments or ["#"]
 
-            fields = []
-            line_pos = 0
+        self.fields_title_have = fields_title_have
 
-            while line_pos < len(line):
+        # Remove comments from the input file
 
-                # Skip any space at the beginning of the field (if there
-                # should be leading space, there should be a quotation mark
-                # in the CSV file)
+        comments_regexes, comments_strings = self.comments_split(comments)
+        for comment in comments_regexes:
+            data = comment.sub("", data)
 
-                while line_pos < len(line) and line[line_pos] == " ":
-                    line_pos = line_pos + 1
+        lines = map(string.strip, re.split("[\r\n]+", data))
 
-                field = ""
-                quotes_level = 0
-                llen = len(line)
-                while line_pos < llen:
+        # Remove all comments that are of type string
 
-                    # Skip space at the end of a field (if there is trailing
-                    # space, it should be enclosed in quotation marks)
+        lines = [line for line in lines
+                 if not self.line_is_comment(line, comments_strings)]
 
-                    if quotes_level == 0 and line[line_pos] == " ":
-                        line_pos_temp = line_pos
-                        while line_pos_temp < llen and line[line_pos_temp] == " ":
-                            line_pos_temp = line_pos_temp + 1
-                        if line_pos_temp >= len(line):
-                            break
-                        elif line[line_pos_temp:line_pos_temp+len(separator)]==separator:
-                            line_pos = line_pos_temp
-                    if (quotes_level == 0 and
-                        line[line_pos:line_pos+len(separator)]==separator):
-                        break
-                    elif line[line_pos] == '"':
-                        if quotes_level == 0:
-                            quotes_level = 1
-                        elif line_pos+1 < llen and line[line_pos+1] == '"':
-                            # found a doubled quote mark - save a single quote
-                            field = field + '"'
-                            line_pos = line_pos + 1
-                        else:
-                            quotes_level = 0
-                    else:
-                        field = field + line[line_pos]
-                    line_pos = line_pos + 1
-                line_pos = line_pos + len(separator)
-                if convert_numbers:
-                    for char in field:
-                        if char not in "0123456789.-":
-                            fields.append(field)
-                            break
-                    else:
-                        try:
-                            if "." not in field:
-                                fields.append(int(field))
-                            else:
-                                fields.append(float(field))
-                        except:
-                            fields.append(field)
-                else:
-                    fields.append(field)
-            if line[-len(separator)] == separator:
-                fields.append(field)
+        # Process the input data
 
-            return fields
+        if fields_title_have:
+            self.fields_title = self.line_process(lines[0], convert_numbers,
+                                                  separator)
+            pos_start = 1
+        else:
+            self.fields_title = []
+            pos_start = 0
+        self.data = []
+        for line in lines[pos_start : ]:
+            if line != "":
+                self.data.append(Entry(self.line_process(line, convert_numbers,
+                                                         separator),
+                                       self.fields_title))
+
+
+    def iter_rows(self, file_data, fields_title_have, convert_numbers=0,
+                  separator=None, comments=None, chunk_size=65536):
+
+        """ Generate the entries of a CSV file one at a time.
 
+        Unlike load(), the file is read chunk_size bytes at a time and the
+        entries aren't kept, so memory use doesn't grow with the size of
+        the file.  The entries are the same as load() would produce,
+        except that regular expression comments are removed from each
+        line rather than from the file as a whole.  The fields titles are
+        set, but not the data.
+
+        Arguments:
+            file_data                     : The name of the CSV file or an
+                                            open file
+            fields_title_have : 0         : file has no title fields
+                                otherwise : file has title fields
+            convert_numbers   : 0         : store everything as string's
+                                otherwise : store fields that can be
+                                            converted to ints or
+                                            floats to that Python type
+                                            defaults to 0
+            separator                     : The field delimiter (optional)
+            comments                      : A list of strings and regular expressions
+                                            to remove comments (defaults to ['#'])
+            chunk_size                    : How much to read at a time
+        """
 
         separator = separator or self.separator
         comments = comments or ["#"]
+        comments_regexes, comments_strings = self.comments_split(comments)
 
         self.fields_title_have = fields_title_have
+        if fields_title_have:
+            # taken from the first line
+            self.fields_title = None
+        else:
+            self.fields_title = []
+
+        if hasattr(file_data, "read"):
+            file_close = 0
+        else:
+            file_data = open(file_data, 'r')
+            file_close = 1
+        try:
+            for line in self.lines_read(file_data, chunk_size):
+                for comment in comments_regexes:
+                    line = comment.sub("", line)
+                line = string.strip(line)
+                if self.line_is_comment(line, comments_strings):
+                    continue
+                if self.fields_title is None:
+                    self.fields_title = self.line_process(line,
+                                                          convert_numbers,
+                                                          separator)
+                elif line != "":
+                    yield Entry(self.line_process(line, convert_numbers,
+                                                  separator),
+                                self.fields_title)
+            if self.fields_title is None:
+                # nothing but comments
+                self.fields_title = []
+        finally:
+            if file_close:
+                file_data.close()
+
+
+
+    def lines_read(self, file_data, chunk_size):
+
+        """ Generate the lines of an open file, reading a chunk at a time.
+
+        Lines end at any run of carriage returns and newlines, as in
+        input(), so a run split between two chunks still ends one line.
+        """
+
+        rest = None
+        while 1:
+            chunk = file_data.read(chunk_size)
+            if not chunk:
+                break
+            if rest is None:
+                rest = ""
+            elif not rest:
+                # the end of a run of line endings we've already split on
+                chunk = string.lstrip(chunk, "\r\n")
+            lines = re.split("[\r\n]+", rest + chunk)
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        yield rest or ""
+
+
+
+    def load_parallel(self, file_data_name, fields_title_have,
+                      convert_numbers=0, separator=None, comments=None,
+                      processes=None, chunk_size=4194304):
+
+        """ Load up a CSV file, parsing chunks of it in several processes.
+
+        The file is split into chunks of whole lines, each parsed by
+        iter_rows() in a multiprocessing.Pool, and the entries put back
+        together in order.  So the entries are the same as iter_rows()
+        would produce.
+
+        Turning the rows sent back by the workers into Entry's is left to
+        this process, as pickling Entry's would cost more than it saves.
+        That takes about a ninth as long as parsing them (0.22s against
+        1.8s for 200,000 short rows), so the speedup falls short of linear
+        and, however many CPUs there are, loading gets no more than about
+        nine times faster.
+
+        Arguments:
+            file_data_name                : The name of the CSV file
+            fields_title_have : 0         : file has no title fields
+                                otherwise : file has title fields
+            convert_numbers   : 0         : store everything as string's
+                                otherwise : store fields that can be
+                                            converted to ints or
+                                            floats to that Python type
+                                            defaults to 0
+            separator                     : The field delimiter (optional)
+            comments                      : A list of strings and regular expressions
+                                            to remove comments (defaults to ['#'])
+            processes                     : How many processes to parse with
+                                            (defaults to the number of CPUs,
+                                            1 parses in this process)
+            chunk_size                    : How much of the file each chunk
+                                            holds, roughly
+        """
+
+        separator = separator or self.separator
+        comments = comments or ["#"]
+        # complain about bad comments here rather than in the pool
+        self.comments_split(comments)
+
+        file_data = open(file_data_name, 'r')
+        try:
+            offsets = self.chunks_find(file_data, chunk_size)
+        finally:
+            file_data.close()
+        jobs = []
+        for chunk_pos in range(len(offsets) - 1):
+            jobs.append((file_data_name, offsets[chunk_pos],
+                         offsets[chunk_pos + 1],
+                         fields_title_have and chunk_pos == 0,
+                         convert_numbers, separator, comments))
+
+        self.fields_title_have = fields_title_have
+        self.fields_title = []
+        self.data = []
+        if processes == 1 or len(jobs) < 2:
+            pool = None
+            results = itertools.imap(_chunk_parse, jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(_chunk_parse, jobs)
+        # the entries are lots of small objects, which would otherwise
+        # trigger several pointless garbage collections
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for fields_title, rows in results:
+                if fields_title == [] and len(jobs) > 1:
+                    # the first chunk was nothing but comments, so the
+                    # titles are further on
+                    self.data = list(self.iter_rows(file_data_name,
+                                                    fields_title_have,
+                                                    convert_numbers,
+                                                    separator, comments))
+                    return
+                if fields_title is not None:
+                    self.fields_title = fields_title
+                fields_title = self.fields_title
+                self.data.extend([Entry(fields, fields_title)
+                                  for fields in marshal.loads(rows)])
+        finally:
+            if enabled:
+                gc.enable()
+            if pool is not None:
+                pool.terminate()
+
+
+
+    def chunks_find(self, file_data, chunk_size):
+
+        """ Return the offsets splitting an open file into chunks of lines.
+
+        Every chunk but the last holds at least chunk_size bytes and ends
+        just after a carriage return or newline.  Quotes don't matter, as
+        a quoted field never continues past the end of its line.
+        """
+
+        file_data.seek(0, 2)
+        size = file_data.tell()
+        offsets = [0]
+        while offsets[-1] + chunk_size < size:
+            file_data.seek(offsets[-1] + chunk_size)
+            offset = file_data.tell()
+            while 1:
+                block = file_data.read(65536)
+                if not block:
+                    break
+                match = re.search("[\r\n]", block)
+                if match:
+                    offset = offset + match.end()
+                    break
+                offset = offset + len(block)
+            offsets.append(offset)
+        if offsets[-1] < size:
+            offsets.append(size)
+        return offsets
 
-        # Remove comments from the input file
 
+
+    def comments_split(self, comments):
+
+        """ Separate regular expression comments from string comments. """
+
+        comments_regexes = []
         comments_strings = []
         for comment in comments:
-            if type(comment) == types.InstanceType:
-                data = comment.sub("", data)
-            elif type(comment) == types.StringType:
+            if type(comment) == types.StringType:
                 comments_strings.append(comment)
+            elif hasattr(comment, "sub"):
+                comments_regexes.append(comment)
             else:
-                raise Exception("Invalid comment type '" + comment + "'")
+                raise Exception("Invalid comment type '%s'" % `comment`)
+        return comments_regexes, comments_strings
 
-        lines = map(string.strip, re.split("[\r\n]+", data))
 
-        # Remove all comments that are of type string
 
-        lines_pos = 0
-        while lines_pos < len(lines):
-            line = lines[lines_pos]
-            line_pos = 0
+    def line_is_comment(self, line, comments_strings):
+
+        """ Return whether line starts with one of comments_strings. """
+
+        line_pos = 0
+        while line_pos < len(line) and line[line_pos] == " ":
+            line_pos = line_pos + 1
+        for comment in comments_strings:
+            if (line_pos + len(comment) < len(line) and
+                line[line_pos:line_pos+len(comment)] == comment):
+                return 1
+        return 0
+
+
+
+    def line_process(self, line, convert_numbers, separator):
+
+        """ Split one line of CSV data into a list of fields.
+
+        Lines without quotes are split with string.split and the rest with
+        a regular expression for the separator, giving the same fields
+        line_process_slow would, only much faster.
+        """
+
+        # the regular expression relies on the separator containing
+        # neither spaces nor quotes, and a line ending with spaces (which
+        # input() strips) can add an empty field
+        if (line[-1:] == " " or not separator or " " in separator or
+            '"' in separator):
+            return self.line_process_slow(line, convert_numbers, separator)
+
+        if '"' in line:
+            fields_raw = self.fields_scan(line, separator)
+        else:
+            fields_raw = map(string.strip, string.split(line, separator),
+                             [" "] * (string.count(line, separator) + 1))
+            if fields_raw[-1] == "":
+                # the line ended with a separator, which doesn't start
+                # another field
+                del fields_raw[-1]
+
+        if convert_numbers:
+            fields = map(self.field_convert, fields_raw)
+        else:
+            fields = fields_raw[:]
+        # line_process_slow repeats the last field of a line ending with a
+        # (single character) separator
+        if line[-len(separator)] == separator:
+            fields.append(fields_raw[-1])
+
+        return fields
+
+
+
+    def fields_scan(self, line, separator):
+
+        """ Split a line containing quotes into unconverted fields. """
+
+        try:
+            fields_find = self.field_regexes[separator]
+        except KeyError:
+            sep = re.escape(separator)
+            # a field is any mix of quoted strings (which may contain
+            # doubled quotes and, if unterminated, run to the end of the
+            # line), unquoted text and spaces which aren't followed by the
+            # separator.  Leading spaces and spaces before the separator
+            # are dropped.
+            fields_find = re.compile(r' *((?:"(?:[^"]|"")*"?|'
+                                     r'(?:(?!%s)[^" ])+|'
+                                     r' +(?![ ]|%s))*)'
+                                     r'(?: *%s)?' % (sep, sep, sep)).findall
+            self.field_regexes[separator] = fields_find
+
+        # every match but the last (empty) one at the end of the line
+        # consumes a separator or ends the line, so they follow on from
+        # one another
+        fields = fields_find(line)
+        del fields[-1]
+        for field_pos in range(len(fields)):
+            field = fields[field_pos]
+            if '"' not in field:
+                continue
+            if (len(field) > 1 and field[0] == field[-1] == '"' and
+                '"' not in field[1:-1]):
+                # the usual case, a simple quoted string
+                fields[field_pos] = field[1:-1]
+            else:
+                parts = []
+                for part in quote_regex.finditer(field):
+                    if part.group(1) is None:
+                        parts.append(part.group(0))
+                    else:
+                        parts.append(string.replace(part.group(1), '""',
+                                                    '"'))
+                fields[field_pos] = string.join(parts, "")
+        return fields
+
+
+
+    def field_convert(self, field):
+
+        """ Convert field to an int or float if it looks like one. """
+
+        for char in field:
+            if char not in "0123456789.-":
+                return field
+        try:
+            if "." not in field:
+                return int(field)
+            else:
+                return float(field)
+        except:
+            return field
+
+
+
+    def line_process_slow(self, line, convert_numbers, separator):
+
+        """ Split one line of CSV data into a list of fields.
+
+        The original character at a time parser, kept as the reference
+        line_process is tested against and for separators it can't handle.
+        """
+
+        fields = []
+        line_pos = 0
+
+        while line_pos < len(line):
+
+            # Skip any space at the beginning of the field (if there
+            # should be leading space, there should be a quotation mark
+            # in the CSV file)
+
             while line_pos < len(line) and line[line_pos] == " ":
                 line_pos = line_pos + 1
-            found_comment = 0
-            for comment in comments_strings:
-                if (line_pos + len(comment) < len(line) and
-                    line[line_pos:line_pos+len(comment)] == comment):
-                    found_comment = 1
+
+            field = ""
+            quotes_level = 0
+            llen = len(line)
+            while line_pos < llen:
+
+                # Skip space at the end of a field (if there is trailing
+                # space, it should be enclosed in quotation marks)
+
+                if quotes_level == 0 and line[line_pos] == " ":
+                    line_pos_temp = line_pos
+                    while line_pos_temp < llen and line[line_pos_temp] == " ":
+                        line_pos_temp = line_pos_temp + 1
+                    if line_pos_temp >= len(line):
+                        break
+                    elif line[line_pos_temp:line_pos_temp+len(separator)]==separator:
+                        line_pos = line_pos_temp
+                if (quotes_level == 0 and
+                    line[line_pos:line_pos+len(separator)]==separator):
                     break
-            if found_comment:
-                del lines[lines_pos]
+                elif line[line_pos] == '"':
+                    if quotes_level == 0:
+                        quotes_level = 1
+                    elif line_pos+1 < llen and line[line_pos+1] == '"':
+                        # found a doubled quote mark - save a single quote
+                        field = field + '"'
+                        line_pos = line_pos + 1
+                    else:
+                        quotes_level = 0
+                else:
+                    field = field + line[line_pos]
+                line_pos = line_pos + 1
+            line_pos = line_pos + len(separator)
+            if convert_numbers:
+                for char in field:
+                    if char not in "0123456789.-":
+                        fields.append(field)
+                        break
+                else:
+                    try:
+                        if "." not in field:
+                            fields.append(int(field))
+                        else:
+                            fields.append(float(field))
+                    except:
+                        fields.append(field)
             else:
-                lines_pos = lines_pos + 1
-
-        # Process the input data
+                fields.append(field)
+        if line[-len(separator)] == separator:
+            fields.append(field)
 
-        if fields_title_have:
-            self.fields_title = line_process(lines[0], convert_numbers, separator)
-            pos_start = 1
-        else:
-            self.fields_title = []
-            pos_start = 0
-        self.data = []
-        for line in lines[pos_start : ]:
-            if line != "":
-                self.data.append(Entry(line_process(line, convert_numbers, separator),
-                                       self.fields_title))
+        return fields
 
 
     def line_make(self, entry, separator = None,
@@ -357,28 +709,136 @@ class CSV(UserList.UserList):
 
 
 
-    def duplicates_eliminate(self):
+    def duplicates_eliminate(self, keys = None):
 
-        """ Eliminate duplicates (this may result in a reordering of the entries) """
+        """ Eliminate duplicates, keeping the first of each in its place.
 
-        # To eliminate duplicates, we first get Python to sort the list for us;
-        # then all we have to do is to check to see whether consecutive elements are
-        # the same, and delete them
-        # This give us O(<sort>) + O(n) rather than the more obvious O(n * n) speed
-        # algorithm
+        Arguments:
+            keys : The titles or positions of the fields which make entries
+                   duplicates (optional, defaults to all of them)
+        """
 
-        # XXX Could be done more efficiently for multiple duplicates by deleting a
-        # slice of similar elements rather than deleting them individually
+        # Remembering the keys seen in a dictionary gives us O(n) and keeps
+        # the order, rather than sorting and then deleting duplicates from
+        # the middle of the list one at a time
+
+        seen = {}
+        data = []
+        for entry in self.data:
+            key = self.entry_key(entry, keys)
+            if key not in seen:
+                seen[key] = 1
+                data.append(entry)
+        self.data[:] = data
 
-        self.sort()
-        data_pos = 1
-        entry_last = self.data[0]
-        while data_pos < len(self.data):
-            if self.data[data_pos] == entry_last:
-                del self.data[data_pos]
-            else:
-                entry_last = self.data[data_pos]
-                data_pos = data_pos + 1
+
+
+    def duplicates_eliminate_file(self, file_in_name, file_out_name,
+                                  fields_title_have, keys = None,
+                                  convert_numbers = 0, separator = None,
+                                  comments = None, partitions = 16,
+                                  quote = 0, quote_numbers = 0):
+
+        """ Copy a CSV file without its duplicate entries, for files too
+        big for duplicates_eliminate().
+
+        The entries are spread between partitions temporary files by the
+        hash of their keys, so duplicates always end up in the same one.
+        Each file is deduplicated in turn, so only about 1 / partitions of
+        the keys are in memory at once, and what is left of them merged
+        back into the original order.  The fields titles are set.
+
+        Arguments:
+            file_in_name                  : The name of the CSV file
+            file_out_name                 : The name of the CSV file to save to
+            fields_title_have : 0         : file has no title fields
+                                otherwise : file has title fields
+            keys                          : The titles or positions of the
+                                            fields which make entries
+                                            duplicates (optional, defaults
+                                            to all of them)
+            convert_numbers   : 0         : store everything as string's
+                                otherwise : store fields that can be
+                                            converted to ints or
+                                            floats to that Python type
+                                            defaults to 0
+            separator                     : The field delimiter (optional)
+            comments                      : A list of strings and regular expressions
+                                            to remove comments (defaults to ['#'])
+            partitions                    : How many temporary files to use
+            quote                         : Whether to quote fields
+            quote_numbers                 : If quoting, whether to quote numbers
+                                            as well
+        """
+
+        separator = separator or self.separator
+
+        spills = []
+        file_out = None
+        try:
+            for partition in range(partitions):
+                spills.append(tempfile.TemporaryFile())
+            entry_pos = 0
+            for entry in self.iter_rows(file_in_name, fields_title_have,
+                                        convert_numbers, separator,
+                                        comments):
+                partition = hash(self.entry_key(entry, keys)) % partitions
+                marshal.dump((entry_pos, entry.data), spills[partition])
+                entry_pos = entry_pos + 1
+
+            # Keep the first entry of each key in each partition; they were
+            # written in order, so what's left is still in order
+
+            for partition in range(partitions):
+                spill = spills[partition]
+                spill.seek(0)
+                spills[partition] = tempfile.TemporaryFile()
+                seen = {}
+                for entry_pos, fields in self.spill_read(spill):
+                    key = self.entry_key(Entry(fields, self.fields_title),
+                                         keys)
+                    if key not in seen:
+                        seen[key] = 1
+                        marshal.dump((entry_pos, fields), spills[partition])
+                spill.close()
+                spills[partition].seek(0)
+
+            file_out = open(file_out_name, 'w')
+            if fields_title_have:
+                file_out.write(self.line_make(self.fields_title, separator,
+                                              quote, quote_numbers))
+            for entry_pos, fields in heapq.merge(*map(self.spill_read,
+                                                      spills)):
+                file_out.write(self.line_make(fields, separator, quote,
+                                              quote_numbers))
+        finally:
+            for spill in spills:
+                spill.close()
+            if file_out is not None:
+                file_out.close()
+
+
+
+    def entry_key(self, entry, keys):
+
+        """ Return the fields of entry named by keys (all of them if keys is
+        None) as a tuple. """
+
+        if keys is None:
+            return tuple(entry.data)
+        return tuple(map(entry.__getitem__, keys))
+
+
+
+    def spill_read(self, spill):
+
+        """ Generate the objects marshalled to an open file. """
+
+        while 1:
+            try:
+                yield marshal.load(spill)
+            except EOFError:
+                return
 
 
 
@@ -417,6 +877,298 @@ class CSV(UserList.UserList):
 
 
 
+def _chunk_parse(job):
+
+    """ Parse one chunk of a file for CSV.load_parallel().
+
+    Returns the fields titles (None unless the chunk is meant to hold
+    them) and the fields of each entry, marshalled, which is far quicker
+    to send back than the pickled list.
+    """
+
+    (file_data_name, pos_start, pos_end, fields_title_have, convert_numbers,
+     separator, comments) = job
+    file_data = open(file_data_name, 'r')
+    try:
+        file_data.seek(pos_start)
+        # without the empty line after the last line ending, a chunk of
+        # comments has no titles
+        data = string.rstrip(file_data.read(pos_end - pos_start), "\r\n")
+    finally:
+        file_data.close()
+    csv = CSV(separator)
+    rows = [entry.data for entry in
+            csv.iter_rows(StringIO.StringIO(data), fields_title_have,
+                          convert_numbers, separator, comments,
+                          len(data) or 1)]
+    if fields_title_have:
+        return csv.fields_title, marshal.dumps(rows)
+    return None, marshal.dumps(rows)
+
+
+
+#####################################################################################
+#
+# Columnar CSV class
+#
+
+
+class ColumnarCSV:
+
+    """ Manage CSV data a column at a time.
+
+    Columns whose values (in a sample of the first rows) are all ints are
+    kept in array('l')s and those which are all numbers in array('d')s,
+    which takes a fraction of the memory of a list of Entry's.  Other
+    columns are lists.  A numeric column meeting a value it can't hold
+    later on is turned into a more general one.  Note that ints in a float
+    column come back as floats.
+
+    Methods:
+        __init__()
+        load()         load from file
+        input()        input from string
+        clear()        remove all the entries
+        append()       appends one entry
+        __len__()      number of entries
+        __getitem__()  an entry, built from the columns
+        column()       the storage of one column
+        column_sum(), column_mean(), column_min(), column_max()
+                       aggregate a column, using NumPy if it's available
+    """
+
+
+
+    def __init__(self, separator = ',', sample = 1000):
+
+        """ Initialise ColumnarCSV class instance.
+
+        Arguments:
+        separator    : The field delimiter. Defaults to ','
+        sample       : How many rows to look at to choose column types
+        """
+
+        self.separator = separator
+        self.sample = sample
+
+        self.fields_title_have = 0
+        self.fields_title = []
+        self.clear()
+
+
+
+    def clear(self):
+
+        """ Remove all the entries. """
+
+        self.columns = []
+        # the number of fields in each row
+        self.widths = array.array('l')
+        self.ragged = 0
+
+
+
+    def load(self, file_data_name, fields_title_have,
+             convert_numbers=1, separator=None, comments=None):
+
+        """ Load up a CSV file, replacing any entries already held.
+
+        The arguments are as for CSV.load(), except that numbers are
+        converted by default.
+        """
+
+        self.clear()
+        reader = CSV(separator or self.separator)
+        self.entries_add(reader.iter_rows(file_data_name, fields_title_have,
+                                          convert_numbers, separator,
+                                          comments))
+        self.fields_title_have = fields_title_have
+        self.fields_title = reader.fields_title
+
+
+
+    def input(self, data, fields_title_have,
+              convert_numbers=1, separator=None, comments=None):
+
+        """ Take wodge of CSV data & convert it into internal format.
+
+        The arguments are as for CSV.input(), except that numbers are
+        converted by default.
+        """
+
+        self.load(StringIO.StringIO(data), fields_title_have,
+                  convert_numbers, separator, comments)
+
+
+
+    def entries_add(self, entries):
+
+        """ Append entries, choosing column types from the first ones. """
+
+        entries = iter(entries)
+        sample = list(itertools.islice(entries, self.sample))
+        if not self.widths:
+            self.columns = []
+            for column_pos in range(max(map(len, sample) or [0])):
+                values = [entry[column_pos] for entry in sample
+                                            if column_pos < len(entry)]
+                self.columns.append(self.column_make(values))
+        for entry in sample:
+            self.append(entry)
+        for entry in entries:
+            self.append(entry)
+
+
+
+    def column_make(self, values):
+
+        """ Return an empty column able to hold values. """
+
+        typecode = 'l'
+        for value in values:
+            if type(value) == types.FloatType:
+                typecode = 'd'
+            elif type(value) not in (types.IntType, types.LongType):
+                return []
+        return array.array(typecode)
+
+
+
+    def append(self, entry):
+
+        """ Add an entry (or list of fields). """
+
+        width = len(entry)
+        while len(self.columns) < width:
+            # pad the new column out for the earlier entries
+            self.columns.append([None] * len(self.widths))
+            self.ragged = self.ragged or len(self.widths) > 0
+        if width < len(self.columns):
+            self.ragged = 1
+        for column_pos in range(len(self.columns)):
+            column = self.columns[column_pos]
+            if column_pos < width:
+                value = entry[column_pos]
+            elif type(column) == types.ListType:
+                value = None
+            else:
+                value = 0
+            try:
+                column.append(value)
+            except (TypeError, OverflowError):
+                self.column_promote(column_pos, value).append(value)
+        self.widths.append(width)
+
+
+
+    def column_promote(self, column_pos, value):
+
+        """ Replace a numeric column by one which can hold value. """
+
+        column = self.columns[column_pos]
+        if column.typecode == 'l' and type(value) == types.FloatType:
+            column = array.array('d', column)
+        else:
+            column = list(column)
+        self.columns[column_pos] = column
+        return column
+
+
+
+    def __len__(self):
+
+        return len(self.widths)
+
+
+
+    def __getitem__(self, x):
+
+        width = self.widths[x]
+        if x < 0:
+            x = x + len(self.widths)
+        return Entry(map(lambda column, x=x: column[x], self.columns[:width]),
+                     self.fields_title)
+
+
+
+    def column(self, x):
+
+        """ Return the storage (array or list) of column x.
+
+        x is the column's position or its title.  If some entries have
+        fewer fields than others, the column is padded with zeros or Nones
+        for them.
+        """
+
+        if type(x) != types.IntType:
+            try:
+                x = self.fields_title.index(x)
+            except ValueError:
+                raise KeyError, "No column title named '%s'" % x
+        return self.columns[x]
+
+
+
+    def column_values(self, x):
+
+        """ Return column x, as a NumPy array if possible. """
+
+        column = self.column(x)
+        if self.ragged:
+            if type(x) != types.IntType:
+                x = self.fields_title.index(x)
+            values = []
+            for entry_pos in range(len(self.widths)):
+                if self.widths[entry_pos] > x:
+                    values.append(column[entry_pos])
+            return values
+        if numpy is not None and type(column) != types.ListType:
+            return numpy.frombuffer(column, column.typecode)
+        return column
+
+
+
+    def column_sum(self, x):
+
+        """ Return the sum of column x. """
+
+        values = self.column_values(x)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.sum().item()
+        return sum(values)
+
+
+
+    def column_mean(self, x):
+
+        """ Return the mean of column x. """
+
+        return float(self.column_sum(x)) / len(self.column_values(x))
+
+
+
+    def column_min(self, x):
+
+        """ Return the smallest value in column x. """
+
+        values = self.column_values(x)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.min().item()
+        return min(values)
+
+
+
+    def column_max(self, x):
+
+        """ Return the largest value in column x. """
+
+        values = self.column_values(x)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.max().item()
+        return max(values)
+
+
+
 #####################################################################################
 #
 # CSV data entry class
@@ -500,3 +1252,197 @@ class Entry(UserList.UserList):
     def __str__(self):
 
         return `self.data`
+
+
+
+def _test():
+    import StringIO, tempfile, os
+
+    print "testing iter_rows against input"
+    lines = ['# a comment', 'name, count ,"price"',
+             'apple, 3, 1.25', '"pear, green",12,0.5',
+             '', '  # indented comment', '"say ""hi""" ,  -7 , x',
+             'plum,,', '#', 'last, 1, 2.0']
+    for eol in ("\n", "\r\n", "\r"):
+        data = string.join(lines, eol) + eol
+        for titles in (0, 1):
+            for convert in (0, 1):
+                c = CSV()
+                c.input(data, titles, convert)
+                expected = map(lambda e: e.data, c.data)
+                for chunk_size in (1, 2, 3, 7, 65536):
+                    r = CSV()
+                    rows = r.iter_rows(StringIO.StringIO(data), titles,
+                                       convert, chunk_size=chunk_size)
+                    rows = map(lambda e: e.data, rows)
+                    assert rows == expected, (eol, chunk_size, rows)
+                    assert r.fields_title == c.fields_title, r.fields_title
+
+    print "testing iter_rows from a file"
+    fname = tempfile.mktemp()
+    f = open(fname, "w")
+    f.write("a,b\n")
+    for i in range(1000):
+        f.write('%d,"%d"\n' % (i, i * 2))
+    f.close()
+    try:
+        n = 0
+        for entry in CSV().iter_rows(fname, 1, 1, chunk_size=100):
+            assert entry["b"] == entry["a"] * 2, entry
+            n = n + 1
+        assert n == 1000, n
+        c = CSV()
+        c.load(fname, 1, 1)
+        assert len(c) == 1000
+    finally:
+        os.unlink(fname)
+
+    print "testing line_process against line_process_slow"
+    import random
+    rng = random.Random(0)
+    c = CSV()
+    corpus = ['a,b,c', ' a , b ,c', 'a,b,', ',', ',,', 'a, ,b', '"a,b",c',
+              '"a ""b"" c", d', '"unterminated, quote', 'x"y"z,"q"r',
+              '"a" "b",c', '" a ",b', '""', '"""",""""""', '1,-2,3.5,1.2.3',
+              '"1",2,', 'a,"b,', 'a  b , c', '-,.,-.', '"', 'a"', 'a,"']
+    alphabet = 'ab ,;:"1.-'
+    for i in range(5000):
+        corpus.append(string.join(map(lambda i, rng=rng, alphabet=alphabet:
+                                      rng.choice(alphabet),
+                                      range(rng.randrange(1, 20))), ""))
+    def parse(process, line, convert, separator):
+        # short lines raise IndexError with long separators
+        try:
+            return process(line, convert, separator)
+        except IndexError:
+            return IndexError
+    for separator in (",", ";", "::", "\t", " ", '"', "ab"):
+        for line in corpus:
+            for convert in (0, 1):
+                expected = parse(c.line_process_slow, line, convert, separator)
+                fields = parse(c.line_process, line, convert, separator)
+                assert fields == expected, (line, separator, fields, expected)
+    assert parse(c.line_process, "", 0, ",") is IndexError
+
+    print "testing ColumnarCSV"
+    data = ("name,count,price,code\n"
+            "apple,3,1.25,7\n"
+            "pear,12,0.5,x\n"
+            "plum,4,2,9\n")
+    c = CSV()
+    c.input(data, 1, 1)
+    cc = ColumnarCSV(sample=2)
+    cc.input(data, 1)
+    assert len(cc) == len(c) == 3
+    for entry_pos in range(len(c)):
+        assert cc[entry_pos].data == c[entry_pos].data, cc[entry_pos]
+    assert cc[-1]["name"] == "plum"
+    assert cc.column("count").typecode == 'l'
+    assert cc.column("price").typecode == 'd'
+    # the sample didn't include the 9, but code was promoted to a list
+    assert cc.column("code") == [7, "x", 9], cc.column("code")
+    assert cc.column_sum("count") == 19
+    assert cc.column_mean("price") == 1.25
+    assert cc.column_min(1) == 3 and cc.column_max(1) == 12
+    cc = ColumnarCSV()
+    cc.input("1,2\n3\n4,5,6\n", 0)
+    assert map(lambda e: e.data, [cc[0], cc[1], cc[2]]) == \
+           [[1, 2], [3], [4, 5, 6]]
+    assert cc.column_sum(1) == 7 and cc.column_mean(1) == 3.5
+    assert cc.column_sum(2) == 6
+    # loading again replaces the entries, as with CSV
+    cc.input("x,y,z\nfoo,5,6\n", 1)
+    assert len(cc) == 1 and cc[0].data == ["foo", 5, 6], cc[0]
+    assert cc.fields_title == ["x", "y", "z"] and not cc.ragged
+    assert cc.column("y").typecode == 'l'
+
+    print "testing load_parallel"
+    lines = ['# a comment', 'name, count ,"price"',
+             'apple, 3, 1.25', '"pear, green",12,0.5',
+             '', '  # indented comment', '"say ""hi""" ,  -7 , x',
+             'plum,,', '#', 'last, 1, 2.0']
+    file_data_name = tempfile.mktemp()
+    try:
+        for eol in ("\n", "\r\n", "\r"):
+            data = string.join(lines * 50, eol) + eol
+            open(file_data_name, 'w').write(data)
+            for titles in (0, 1):
+                for convert in (0, 1):
+                    c = CSV()
+                    c.load(file_data_name, titles, convert)
+                    expected = map(lambda e: e.data, c.data)
+                    for processes in (1, 3):
+                        for chunk_size in (1, 5, 100, 1 << 20):
+                            r = CSV()
+                            r.load_parallel(file_data_name, titles, convert,
+                                            processes=processes,
+                                            chunk_size=chunk_size)
+                            rows = map(lambda e: e.data, r.data)
+                            assert rows == expected, (eol, chunk_size)
+                            assert r.fields_title == c.fields_title
+        # titles beyond the first chunk
+        open(file_data_name, 'w').write("# x\n" * 10 + "a,b\n1,2\n")
+        r = CSV()
+        r.load_parallel(file_data_name, 1, 1, processes=2, chunk_size=4)
+        assert r.fields_title == ["a", "b"], r.fields_title
+        assert r[0]["b"] == 2
+        open(file_data_name, 'w').write("")
+        r.load_parallel(file_data_name, 1)
+        assert r.data == [] and r.fields_title == []
+    finally:
+        os.unlink(file_data_name)
+
+    print "testing duplicates_eliminate"
+    c = CSV()
+    c.input("a,b,c\n1,x,2\n3,y,4\n1,x,2\n1,z,2\n3,y,4\n1,x,5\n", 1, 1)
+    c.duplicates_eliminate()
+    assert map(lambda e: e.data, c.data) == \
+           [[1, "x", 2], [3, "y", 4], [1, "z", 2], [1, "x", 5]], c.data
+    c.duplicates_eliminate(["a", 2])
+    assert map(lambda e: e.data, c.data) == \
+           [[1, "x", 2], [3, "y", 4], [1, "x", 5]], c.data
+    c.duplicates_eliminate([0])
+    assert map(lambda e: e.data, c.data) == [[1, "x", 2], [3, "y", 4]]
+    c = CSV()
+    c.duplicates_eliminate()
+    assert c.data == []
+
+    print "testing duplicates_eliminate_file"
+    import random
+    rng = random.Random(0)
+    lines = ["id,name,score"]
+    for line_pos in range(2000):
+        lines.append("%d,%s,%d" % (rng.randrange(300), rng.choice("abc"),
+                                   rng.randrange(3)))
+    data = string.join(lines, "\n") + "\n"
+    file_in_name = tempfile.mktemp()
+    file_out_name = tempfile.mktemp()
+    open(file_in_name, 'w').write(data)
+    try:
+        for keys in (None, ["id"], [1, "score"]):
+            for convert in (0, 1):
+                c = CSV()
+                c.input(data, 1, convert)
+                c.duplicates_eliminate(keys)
+                for partitions in (1, 3, 16):
+                    r = CSV()
+                    r.duplicates_eliminate_file(file_in_name, file_out_name,
+                                                1, keys, convert,
+                                                partitions=partitions)
+                    assert r.fields_title == c.fields_title
+                    assert open(file_out_name).read() == c.output(), \
+                           (keys, convert, partitions)
+    finally:
+        os.unlink(file_in_name)
+        if os.path.exists(file_out_name):
+            os.unlink(file_out_name)
+
+    print "testing regular expression comments"
+    c = CSV()
+    c.input("a,b // trailing\nc,d\n", 0, comments=[re.compile(" *//.*")])
+    assert map(lambda e: e.data, c.data) == [["a", "b"], ["c", "d"]], c.data
+
+    print "all CSV tests passed"
+
+if __name__ == "__main__":
+    _test()
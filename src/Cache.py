@@ -23,17 +23,91 @@ of KeyError), just as if they weren't present in the cache.
 
 Ages can be specified as numbers of seconds or as strings consisting of a
 number followed by one of the following units: d,h,m,s
+
+Aged caches keep their entries in a heap ordered by modification time, so
+periodic purging only looks at entries which have actually expired.
+
+Trimming the cache normally sorts every entry by access time, which gets
+expensive for large caches.  You can instead ask for an eviction policy
+which tracks recency as entries are used, so both lookups and evictions
+take constant time:
+
+    c = Cache(size=1000000, policy="lru")
+
+Other policies are "lfu", "2q", "arc" and "tinylfu" (W-TinyLFU), which
+hold up much better than plain LRU when scans are mixed in with a popular
+working set.  A policy is any class listed in the policies dictionary (or
+passed directly as the policy argument) which is instantiated with the
+cache size and provides insert(key), access(key), remove(key), evict(n)
+and clear() methods.  evict(n) forgets and returns up to n victim keys.
+Replacing the value of a cached key counts as an access, not an insert.
+
+If entry sizes vary a lot, counting entries says little about memory use.
+Give the cache a byte budget instead (or as well) and it will trim itself
+to 95% of the budget whenever an insert pushes it over:
+
+    c = Cache(size=0, max_bytes=64*1024*1024, policy="lru")
+
+Each value is charged sys.getsizeof(value) bytes by default, which doesn't
+look inside containers.  Pass a different sizer function to measure values
+more thoroughly, e.g. sizer=lambda v: len(cPickle.dumps(v, 2)).  A value
+bigger than 95% of the budget isn't cached at all.  The number of bytes
+currently charged is reported by stats().
+
+For very large caches, CompactCache takes the same arguments but keeps
+values and timestamps in parallel columns rather than one object per entry,
+which uses considerably less memory.
+
+PersistentCache keeps a log of its contents in a file, so a restarted
+process begins with the entries (and their ages) it had before:
+
+    c = PersistentCache("/var/tmp/hosts.cache", size=100000, age="1d")
+    ...
+    c.close()
+
+Pre-forked servers can share one cache between all their workers by
+creating a SharedCache (which lives in shared memory) before forking:
+
+    c = SharedCache(size=100000, age="1h", slotsize=512)
+
+LoadingCache fills itself by calling a loader function for missing keys.
+Entries past their age are still returned, while a background thread
+fetches a fresh value (stale-while-revalidate):
+
+    c = LoadingCache(lookup_host, size=10000, age="5m")
+
+Call instrument() to have a cache record latency histograms for gets,
+sets, shrinks and purges, and to count evictions by reason (size, bytes
+or age).  snapshot() returns these along with stats() and the distribution
+of entry ages as a dictionary; prometheus() formats the same information
+for a Prometheus scrape.  Uninstrumented caches pay only for a test of
+the instruments attribute.
+
+Cache instances are not thread-safe.  To share a cache between threads use
+ShardedCache, which spreads keys over several separately locked caches:
+
+    c = ShardedCache(shards=16, size=100000, policy="lru")
+
+The cached decorator memoizes a function using a Cache, making sure that
+concurrent calls with the same arguments only compute the result once:
+
+    @cached(size=1000, age="10m")
+    def lookup(host):
+        ...
 """
 
 # This code has been placed in the public domain.
 
-import time, string, re
+import sys, os, time, string, re, heapq, array, threading, functools, bisect
+import cPickle, Queue, mmap, struct, zlib, operator, multiprocessing
+from collections import OrderedDict, namedtuple
 
 class CacheEntry(object):
     __slots__ = ("value", "ftime", "mtime")
     def __init__(self, value):
         self.set(value)
-        self.ftime = time.time()
+        # an entry which has never been fetched has ftime == mtime
+        self.ftime = self.mtime
 
     def get(self):
         self.ftime = time.time()
@@ -46,79 +120,599 @@ class CacheEntry(object):
 class ExpiredError(KeyError):
     pass
 
+class LRUPolicy(object):
+    """least recently used eviction in constant time per operation"""
+    def __init__(self, size):
+        self.order = OrderedDict()
+
+    def insert(self, key):
+        """note a newly added key"""
+        self.order.pop(key, None)
+        self.order[key] = None
+
+    def access(self, key):
+        """move key to the most recently used end"""
+        del self.order[key]
+        self.order[key] = None
+
+    def remove(self, key):
+        """forget key (deleted or expired)"""
+        self.order.pop(key, None)
+
+    def evict(self, n):
+        """remove and return the n least recently used keys"""
+        popitem = self.order.popitem
+        return [popitem(last=False)[0] for i in range(min(n, len(self.order)))]
+
+    def clear(self):
+        self.order.clear()
+
+class LFUPolicy(object):
+    """least frequently used eviction, ties broken by recency"""
+    def __init__(self, size):
+        self.clear()
+
+    def insert(self, key):
+        self.remove(key)
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.minimum = 1
+
+    def access(self, key):
+        n = self.counts[key]
+        self._unlink(key, n)
+        self.counts[key] = n + 1
+        self.buckets.setdefault(n + 1, OrderedDict())[key] = None
+
+    def remove(self, key):
+        n = self.counts.pop(key, None)
+        if n is not None:
+            self._unlink(key, n)
+
+    def _unlink(self, key, n):
+        bucket = self.buckets[n]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[n]
+            if n == self.minimum:
+                self.minimum = None
+
+    def evict(self, n):
+        result = []
+        while len(result) < n and self.counts:
+            if self.minimum is None:
+                self.minimum = min(self.buckets)
+            key = iter(self.buckets[self.minimum]).next()
+            self.remove(key)
+            result.append(key)
+        return result
+
+    def clear(self):
+        self.counts = {}
+        self.buckets = {}
+        self.minimum = None
+
+class TwoQPolicy(object):
+    """2Q eviction: new keys must be seen twice to reach the main LRU list
+
+    First-time keys wait in a FIFO (a1in).  Keys pushed out of that FIFO
+    are remembered (but not cached) in a1out, and are promoted straight to
+    the main list (am) if they show up again.  This keeps one-off scans from
+    flushing the frequently used keys.
+    """
+    def __init__(self, size):
+        self.kin = max(1, size // 4)
+        self.kout = max(1, size // 2)
+        self.clear()
+
+    def insert(self, key):
+        self.remove(key)
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+
+    def access(self, key):
+        if key in self.am:
+            del self.am[key]
+            self.am[key] = None
+
+    def remove(self, key):
+        self.a1in.pop(key, None)
+        self.am.pop(key, None)
+
+    def evict(self, n):
+        result = []
+        while len(result) < n and (self.a1in or self.am):
+            if len(self.a1in) > self.kin or not self.am:
+                key = self.a1in.popitem(last=False)[0]
+                self.a1out[key] = None
+                if len(self.a1out) > self.kout:
+                    self.a1out.popitem(last=False)
+            else:
+                key = self.am.popitem(last=False)[0]
+            result.append(key)
+        return result
+
+    def clear(self):
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+class ARCPolicy(object):
+    """adaptive replacement cache (Megiddo & Modha)
+
+    t1 holds keys seen once recently, t2 keys seen at least twice.  b1 and
+    b2 remember keys recently evicted from each, and hits on them shift the
+    target size of t1 (p) towards whichever list would have kept them.
+    """
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.clear()
+
+    def insert(self, key):
+        self.remove(key)
+        if key in self.b1:
+            self.p = min(self.size,
+                         self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+            if len(self.t1) + len(self.b1) > self.size and self.b1:
+                self.b1.popitem(last=False)
+            elif len(self.b1) + len(self.b2) > self.size and self.b2:
+                self.b2.popitem(last=False)
+
+    def access(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            del self.t2[key]
+        self.t2[key] = None
+
+    def remove(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+
+    def evict(self, n):
+        result = []
+        while len(result) < n and (self.t1 or self.t2):
+            if self.t1 and (len(self.t1) > self.p or not self.t2):
+                key = self.t1.popitem(last=False)[0]
+                self.b1[key] = None
+            else:
+                key = self.t2.popitem(last=False)[0]
+                self.b2[key] = None
+            result.append(key)
+        return result
+
+    def clear(self):
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+class FrequencySketch(object):
+    """count-min sketch of approximate key frequencies
+
+    Counters saturate at 15 and are all halved once the number of
+    increments reaches ten times the cache size, so old popularity fades.
+    """
+    depth = 4
+    seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, size):
+        width = 16
+        while width < size:
+            width *= 2
+        self.width = width
+        self.mask = width - 1
+        self.sample = 10 * max(1, size)
+        self.clear()
+
+    def _slots(self, key):
+        h = hash(key)
+        w = self.width
+        return [i * w + (((h * seed) >> 16) & self.mask)
+                for (i, seed) in enumerate(self.seeds)]
+
+    def increment(self, key):
+        table = self.table
+        for i in self._slots(key):
+            if table[i] < 15:
+                table[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.table = array.array("B", [c >> 1 for c in table])
+            self.additions //= 2
+
+    def frequency(self, key):
+        table = self.table
+        return min([table[i] for i in self._slots(key)])
+
+    def clear(self):
+        self.table = array.array("B", [0]) * (self.depth * self.width)
+        self.additions = 0
+
+class TinyLFUPolicy(object):
+    """W-TinyLFU: a small LRU window in front of a segmented LRU main area
+
+    New keys enter the window.  When the window overflows, its oldest key
+    only displaces the main area's victim if the frequency sketch says it
+    has been requested more often.  The main area is split into probation
+    and protected segments; a hit in probation promotes to protected.
+
+    Cache.shrink() trims to 95% of the size, so the main area is sized to
+    be full after a trim.  Otherwise window keys would always find room
+    in it and the sketch would never be consulted.
+    """
+    def __init__(self, size):
+        size = max(1, size)
+        self.wsize = max(1, size // 100)
+        self.msize = max(1, int(0.95 * size) - self.wsize)
+        self.psize = max(1, self.msize * 4 // 5)
+        self.sketch = FrequencySketch(size)
+        self.clear()
+
+    def insert(self, key):
+        self.remove(key)
+        self.sketch.increment(key)
+        self.window[key] = None
+
+    def access(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            del self.window[key]
+            self.window[key] = None
+        elif key in self.probation:
+            del self.probation[key]
+            self.protected[key] = None
+            if len(self.protected) > self.psize:
+                demoted = self.protected.popitem(last=False)[0]
+                self.probation[demoted] = None
+        else:
+            del self.protected[key]
+            self.protected[key] = None
+
+    def remove(self, key):
+        self.window.pop(key, None)
+        self.probation.pop(key, None)
+        self.protected.pop(key, None)
+
+    def _victim(self):
+        """return the main area's least recently used key (or None)"""
+        for segment in (self.probation, self.protected):
+            if segment:
+                return iter(segment).next()
+        return None
+
+    def evict(self, n):
+        result = []
+        while len(result) < n and (self.window or self.probation or
+                                   self.protected):
+            if len(self.window) > self.wsize:
+                candidate = iter(self.window).next()
+                del self.window[candidate]
+                if len(self.probation) + len(self.protected) < self.msize:
+                    # room in the main area - admit without a contest
+                    self.probation[candidate] = None
+                    continue
+                victim = self._victim()
+                freq = self.sketch.frequency
+                if freq(candidate) <= freq(victim):
+                    result.append(candidate)
+                    continue
+                self.probation[candidate] = None
+            else:
+                victim = self._victim()
+                if victim is None:
+                    victim = iter(self.window).next()
+            self.remove(victim)
+            result.append(victim)
+        return result
+
+    def clear(self):
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch.clear()
+
+class Histogram(object):
+    """counts of observations falling under a fixed set of upper bounds"""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.clear()
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def clear(self):
+        # the extra count is for values above the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def snapshot(self):
+        """return cumulative (bound, count) pairs plus count and sum"""
+        buckets = []
+        total = 0
+        for bound, n in zip(self.bounds + [float("inf")], self.counts):
+            total += n
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+# latency buckets from 1 microsecond to about a second, ages from one
+# second to about twelve days
+LATENCY_BOUNDS = [1e-6 * 2**i for i in range(21)]
+AGE_BOUNDS = [float(2**i) for i in range(21)]
+
+class Instruments(object):
+    """latency histograms and eviction counts for an instrumented Cache"""
+    ops = ("get", "set", "shrink", "purge")
+    reasons = ("size", "bytes", "age")
+
+    def __init__(self):
+        self.latency = {}
+        for op in self.ops:
+            self.latency[op] = Histogram(LATENCY_BOUNDS)
+        self.evictions = dict.fromkeys(self.reasons, 0)
+
+policies = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "2q": TwoQPolicy,
+    "arc": ARCPolicy,
+    "tinylfu": TinyLFUPolicy,
+    }
+
 class Cache(dict):
     """simple cache that uses least recently accessed time to trim size"""
-    def __init__(self,data=None,size=100,age=None):
+    def __init__(self,data=None,size=100,age=None,policy=None,
+                 max_bytes=None,sizer=sys.getsizeof):
         self.size = size
         self.requests = self.hits = 0
         self.inserts = self.unused = 0
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.bytes = 0
+        # key -> size charged against max_bytes
+        self._sizes = {}
+        self.instruments = None
         if isinstance(age, (str, unicode)):
             age = self._cvtage(age)
         self.age = age
+        # (time, key) pairs ordered by age - see purge_old_entries
+        self._expiry = []
+        if isinstance(policy, (str, unicode)):
+            try:
+                policy = policies[policy]
+            except KeyError:
+                raise ValueError("unknown eviction policy: %s" % policy)
+        if policy is not None:
+            policy = policy(size)
+        self.policy = policy
 
     def shrink(self):
         """trim cache to no more than 95% of desired size"""
         trim = max(0, int(len(self)-0.95*self.size))
         if trim:
+            if self.instruments is not None:
+                t = time.time()
+            if self.policy is not None:
+                for k in self.policy.evict(trim):
+                    self._evict(k, "size")
+            else:
+                # sort keys by access times
+                values = zip(self.ftimes(), self.keys())
+                values.sort()
+                for val,k in values[0:trim]:
+                    self._evict(k, "size")
+            if self.instruments is not None:
+                self.instruments.latency["shrink"].observe(time.time()-t)
+
+    def _evict(self, key, reason):
+        """drop key which the eviction policy already forgot"""
+        mtime, ftime = self._times(key)
+        if ftime == mtime:
+            self.unused += 1
+        self._drop(key)
+        if self.max_bytes is not None:
+            self.bytes -= self._sizes.pop(key)
+        if self.instruments is not None:
+            self.instruments.evictions[reason] += 1
+
+    def _charge(self, key, n):
+        """account for key's new value of n bytes against the byte budget"""
+        self.bytes += n - self._sizes.get(key, 0)
+        self._sizes[key] = n
+
+    def shrink_bytes(self):
+        """trim cache to no more than 95% of its byte budget"""
+        target = 0.95 * self.max_bytes
+        if self.bytes <= target:
+            return
+        if self.instruments is not None:
+            t = time.time()
+        if self.policy is not None:
+            while self.bytes > target:
+                victims = self.policy.evict(1)
+                if not victims:
+                    break
+                self._evict(victims[0], "bytes")
+        else:
             # sort keys by access times
             values = zip(self.ftimes(), self.keys())
             values.sort()
-            for val,k in values[0:trim]:
-                if val == 0.0:
-                    self.unused += 1
-                del self[k]
+            for val,k in values:
+                if self.bytes <= target:
+                    break
+                self._evict(k, "bytes")
+        if self.instruments is not None:
+            self.instruments.latency["shrink"].observe(time.time()-t)
+
+    # Entry storage.  Everything else goes through these four methods, so
+    # subclasses (see CompactCache) can lay entries out differently.
+
+    def _store(self, key, val):
+        """save val under key with fresh times, return the mod time"""
+        entry = CacheEntry(val)
+        dict.__setitem__(self, key, entry)
+        return entry.mtime
+
+    def _fetch(self, key):
+        """return key's value and mod time, updating its fetch time"""
+        item = dict.__getitem__(self, key)
+        return item.get(), item.mtime
+
+    def _times(self, key):
+        """return key's mod and fetch times"""
+        item = dict.__getitem__(self, key)
+        return item.mtime, item.ftime
+
+    def _drop(self, key):
+        dict.__delitem__(self, key)
 
     def purge_old_entries(self):
+        """discard entries neither modified nor fetched in last age seconds"""
         if self.age is None:
             return
         t = time.time()
-        for k in self.keys():
-            v = dict.__getitem__(self, k)
-            threshold = t - self.age
+        threshold = t - self.age
+        instruments = self.instruments
+        expiry = self._expiry
+        while expiry and expiry[0][0] < threshold:
+            stamp, k = heapq.heappop(expiry)
+            if not dict.__contains__(self, k):
+                continue
+            mtime, ftime = self._times(k)
+            if stamp < mtime:
+                # replaced since this pair was pushed
+                continue
+            last = max(mtime, ftime)
             # modified or fetched in last self.age seconds?
-            if threshold > v.mtime and threshold > v.ftime:
-                if v.ftime == 0.0:
+            if threshold > last:
+                if ftime == mtime:
                     self.unused += 1
                 del self[k]
+                if instruments is not None:
+                    instruments.evictions["age"] += 1
+            else:
+                heapq.heappush(expiry, (last, k))
+        if instruments is not None:
+            instruments.latency["purge"].observe(time.time()-t)
+
+    def _expiry_rebuild(self):
+        """replace the expiry heap with one pair per live entry
+
+        Overwritten and evicted keys leave pairs behind which would otherwise
+        only be dropped when they reach the top of the heap, so the heap
+        would grow with the write rate rather than the cache size.
+        """
+        self._expiry[:] = [(self._times(k)[0], k) for k in self.keys()]
+        heapq.heapify(self._expiry)
 
     def __setitem__(self,key,val):
+        if self.instruments is not None:
+            t = time.time()
         self.inserts += 1
         if self.age is not None and self.requests % 1000 == 0:
             self.purge_old_entries()
 
-        if (key not in self and
+        if self.max_bytes is not None:
+            n = self.sizer(val)
+            if n > 0.95 * self.max_bytes:
+                # shrink_bytes() trims to 95% of the budget, so making room
+                # would flush every other entry and then this one - refuse
+                # it (along with any older value for key)
+                if key in self:
+                    if self.policy is not None:
+                        self.policy.remove(key)
+                    self._evict(key, "bytes")
+                if self.instruments is not None:
+                    self.instruments.latency["set"].observe(time.time()-t)
+                return
+        present = key in self
+        if (not present and
             self.size and
             len(self) >= self.size):
             self.shrink()
-        dict.__setitem__(self, key, CacheEntry(val))
+        mtime = self._store(key, val)
+        if self.policy is not None:
+            # replacing a value counts as a use - insert() would throw
+            # away the key's history (its count, list or segment)
+            if present:
+                self.policy.access(key)
+            else:
+                self.policy.insert(key)
+        if self.age is not None:
+            heapq.heappush(self._expiry, (mtime, key))
+            if len(self._expiry) > 2 * len(self) + 100:
+                self._expiry_rebuild()
+        if self.max_bytes is not None:
+            self._charge(key, n)
+            if self.bytes > self.max_bytes:
+                self.shrink_bytes()
+        if self.instruments is not None:
+            self.instruments.latency["set"].observe(time.time()-t)
 
     def __getitem__(self,key):
         """like normal __getitem__ but updates time of fetched entry"""
-        self.requests += 1
-        item = dict.__getitem__(self, key)
-        val = item.get()
+        if self.instruments is not None:
+            t = time.time()
+        try:
+            self.requests += 1
+            val, mtime = self._fetch(key)
+            if self.policy is not None:
+                self.policy.access(key)
 
-        if self.age is not None:
-            if self.requests % 1000 == 0:
-                self.purge_old_entries()
+            if self.age is not None:
+                if self.requests % 1000 == 0:
+                    self.purge_old_entries()
 
-            # check to make sure value has not expired
-            if time.time()-self.age > item.mtime:
-                if item.ftime == 0.0:
-                    self.unused += 1
-                del self[key]
-                raise ExpiredError(key)
+                # check to make sure value has not expired
+                if time.time()-self.age > mtime:
+                    del self[key]
+                    if self.instruments is not None:
+                        self.instruments.evictions["age"] += 1
+                    raise ExpiredError(key)
 
-        # if we get here there was no KeyError
-        self.hits = self.hits + 1
-        return val
+            # if we get here there was no KeyError
+            self.hits = self.hits + 1
+            return val
+        finally:
+            if self.instruments is not None:
+                self.instruments.latency["get"].observe(time.time()-t)
+
+    def __delitem__(self, key):
+        self._drop(key)
+        if self.policy is not None:
+            self.policy.remove(key)
+        if self.max_bytes is not None:
+            self.bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        dict.clear(self)
+        del self._expiry[:]
+        self._sizes.clear()
+        self.bytes = 0
+        if self.policy is not None:
+            self.policy.clear()
 
     def has_key(self,key):
         try:
-            v = dict.__getitem__(self, key)
+            mtime, ftime = self._times(key)
         except (KeyError,ExpiredError):
             return 0
-        if self.age is not None and time.time()-self.age > v.mtime:
+        if self.age is not None and time.time()-self.age > mtime:
             return 0
         return 1
 
@@ -131,15 +725,15 @@ class Cache(dict):
 
     def values(self):
         """extract values from CacheEntry objects"""
-        return [dict.__getitem__(self,key).get() for key in self]
+        return [self._fetch(key)[0] for key in self]
 
     def ftimes(self):
         """return values' fetch times"""
-        return [dict.__getitem__(self,key).ftime for key in self]
+        return [self._times(key)[1] for key in self]
 
     def mtimes(self):
         """return values' mod times"""
-        return [dict.__getitem__(self,key).mtime for key in self]
+        return [self._times(key)[0] for key in self]
 
     def items(self):
         return map(None, self.keys(), self.values())
@@ -152,12 +746,82 @@ class Cache(dict):
             self[k] = dict[k]
 
     def stats(self):
-        return {
+        stats = {
             'hits': self.hits,
             'inserts': self.inserts,
             'requests': self.requests,
             'unused': self.unused,
             }
+        if self.max_bytes is not None:
+            stats['bytes'] = self.bytes
+        return stats
+
+    def instrument(self, enable=True):
+        """start (or stop) collecting latency and eviction statistics"""
+        if enable:
+            if self.instruments is None:
+                self.instruments = Instruments()
+        else:
+            self.instruments = None
+
+    def snapshot(self):
+        """return stats, instrument readings and the current entry ages"""
+        now = time.time()
+        ages = Histogram(AGE_BOUNDS)
+        for mtime in self.mtimes():
+            ages.observe(now - mtime)
+        snapshot = {
+            'stats': self.stats(),
+            'entries': len(self),
+            'ages': ages.snapshot(),
+            }
+        if self.instruments is not None:
+            snapshot['evictions'] = self.instruments.evictions.copy()
+            latency = snapshot['latency'] = {}
+            for op, hist in self.instruments.latency.items():
+                latency[op] = hist.snapshot()
+        return snapshot
+
+    # stats() values which can go down; the rest only ever count up
+    gauges = ("bytes",)
+
+    def prometheus(self, prefix="cache"):
+        """return snapshot() in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        def histogram(name, hist, labels=""):
+            for bound, n in hist['buckets']:
+                if bound == float("inf"):
+                    le = "+Inf"
+                else:
+                    le = repr(bound)
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, le, n))
+            if labels:
+                labels = "{%s}" % labels.rstrip(",")
+            lines.append("%s_sum%s %r" % (name, labels, hist['sum']))
+            lines.append("%s_count%s %d" % (name, labels, hist['count']))
+        stats = snapshot['stats']
+        for k in sorted(stats):
+            if k in self.gauges:
+                lines.append("# TYPE %s_%s gauge" % (prefix, k))
+                lines.append("%s_%s %d" % (prefix, k, stats[k]))
+            else:
+                lines.append("# TYPE %s_%s_total counter" % (prefix, k))
+                lines.append("%s_%s_total %d" % (prefix, k, stats[k]))
+        lines.append("# TYPE %s_entries gauge" % prefix)
+        lines.append("%s_entries %d" % (prefix, snapshot['entries']))
+        lines.append("# TYPE %s_entry_age_seconds histogram" % prefix)
+        histogram("%s_entry_age_seconds" % prefix, snapshot['ages'])
+        if 'evictions' in snapshot:
+            lines.append("# TYPE %s_evictions_total counter" % prefix)
+            for reason in sorted(snapshot['evictions']):
+                lines.append('%s_evictions_total{reason="%s"} %d' %
+                             (prefix, reason, snapshot['evictions'][reason]))
+            name = "%s_operation_seconds" % prefix
+            lines.append("# TYPE %s histogram" % name)
+            for op in sorted(snapshot['latency']):
+                histogram(name, snapshot['latency'][op], 'op="%s",' % op)
+        return "\n".join(lines) + "\n"
 
     def __repr__(self):
         l = []
@@ -183,6 +847,747 @@ class Cache(dict):
             n = n * 24*60*60
         return n
 
+class CompactCache(Cache):
+    """Cache which stores entries in parallel columns instead of objects
+
+    The dictionary maps each key to a slot number.  Values live in a list
+    and the mod and fetch times in array('d') columns indexed by slot, so an
+    entry costs a small int and a few machine words rather than a
+    CacheEntry instance plus two float objects.  Freed slots are reused.
+    """
+    def __init__(self,data=None,size=100,age=None,policy=None,
+                 max_bytes=None,sizer=sys.getsizeof):
+        Cache.__init__(self, data, size, age, policy, max_bytes, sizer)
+        self._columns()
+
+    def _columns(self):
+        self._values = []
+        self._mtimes = array.array("d")
+        self._ftimes = array.array("d")
+        self._free = []
+
+    def _store(self, key, val):
+        slot = dict.get(self, key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._values)
+                self._values.append(None)
+                self._mtimes.append(0.0)
+                self._ftimes.append(0.0)
+            dict.__setitem__(self, key, slot)
+        t = time.time()
+        self._values[slot] = val
+        self._mtimes[slot] = self._ftimes[slot] = t
+        return t
+
+    def _fetch(self, key):
+        slot = dict.__getitem__(self, key)
+        self._ftimes[slot] = time.time()
+        return self._values[slot], self._mtimes[slot]
+
+    def _times(self, key):
+        slot = dict.__getitem__(self, key)
+        return self._mtimes[slot], self._ftimes[slot]
+
+    def _drop(self, key):
+        slot = dict.__getitem__(self, key)
+        dict.__delitem__(self, key)
+        self._values[slot] = None
+        self._free.append(slot)
+
+    def clear(self):
+        Cache.clear(self)
+        self._columns()
+
+class PersistentCache(Cache):
+    """Cache whose entries survive a restart
+
+    Every insert and deletion is appended to a log file.  When the cache is
+    created the log is replayed, so a restarted process starts out warm with
+    each entry's mod and fetch times intact; entries which aged out in the
+    meantime are dropped, and the log is then rewritten as a compact
+    snapshot.  Fetch times are only saved when the log is rewritten, which
+    happens on sync() and close() and whenever the log grows to more than
+    twice the number of live entries.  Values must be picklable.
+    """
+    def __init__(self,filename,size=100,age=None,policy=None,
+                 max_bytes=None,sizer=sys.getsizeof):
+        Cache.__init__(self, None, size, age, policy, max_bytes, sizer)
+        self.filename = filename
+        self._log = None
+        self._records = 0
+        self._load()
+        self.sync()
+
+    def _load(self):
+        entries = {}
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            return
+        try:
+            while True:
+                try:
+                    record = cPickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # a torn record at the end of the log - the previous
+                    # process died in the middle of a write
+                    break
+                if record[0] == "s":
+                    entries[record[1]] = record[2:]
+                else:
+                    entries.pop(record[1], None)
+        finally:
+            f.close()
+
+        if self.age is None:
+            threshold = None
+        else:
+            threshold = time.time() - self.age
+        # reinsert oldest first so recency-based policies see the same order
+        items = [(ftime, key) for (key, (val, mtime, ftime)) in entries.items()
+                   if threshold is None or max(mtime, ftime) >= threshold]
+        items.sort()
+        for ftime, key in items:
+            val, mtime, ftime = entries[key]
+            entry = CacheEntry(val)
+            entry.mtime, entry.ftime = mtime, ftime
+            dict.__setitem__(self, key, entry)
+            if self.policy is not None:
+                self.policy.insert(key)
+            if self.age is not None:
+                heapq.heappush(self._expiry, (mtime, key))
+            if self.max_bytes is not None:
+                self._charge(key, self.sizer(val))
+        if self.size and len(self) > self.size:
+            self.shrink()
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.shrink_bytes()
+
+    def _write(self, data):
+        """append a pickled record to the log"""
+        if self._log is None:
+            return
+        self._log.write(data)
+        self._records += 1
+        if self._records > 2 * len(self) + 1000:
+            self.sync()
+
+    def _store(self, key, val):
+        # pickle the record first, so an unpicklable value is refused before
+        # the entry is half added
+        mtime = time.time()
+        data = cPickle.dumps(("s", key, val, mtime, mtime), 2)
+        Cache._store(self, key, val)
+        entry = dict.__getitem__(self, key)
+        entry.mtime = entry.ftime = mtime
+        self._write(data)
+        return mtime
+
+    def _drop(self, key):
+        Cache._drop(self, key)
+        self._write(cPickle.dumps(("d", key), 2))
+
+    def clear(self):
+        Cache.clear(self)
+        self.sync()
+
+    def copy(self):
+        # a copy would need a log file of its own
+        raise TypeError("PersistentCache instances can't be copied")
+
+    def sync(self):
+        """rewrite the log as a snapshot of the current entries"""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            for key in self:
+                entry = dict.__getitem__(self, key)
+                cPickle.dump(("s", key, entry.value, entry.mtime, entry.ftime),
+                             f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+        self._log = open(self.filename, "ab")
+        self._records = len(self)
+
+    def flush(self):
+        """push buffered log records to the operating system"""
+        if self._log is not None:
+            self._log.flush()
+
+    def close(self):
+        """save a final snapshot and stop logging changes"""
+        if self._log is not None:
+            self.sync()
+            self._log.close()
+            self._log = None
+
+class ShardedCache(object):
+    """thread-safe cache which spreads keys over independently locked shards
+
+    Cache itself is not safe to share between threads (even lookups update
+    access times and counters).  ShardedCache hashes each key onto one of
+    several Cache instances, each guarded by its own lock, so threads only
+    contend when they touch the same shard.  The size is the total for all
+    shards; each shard trims and ages its own entries.
+    """
+    def __init__(self, shards=16, size=100, age=None, policy=None):
+        shardsize = size and (size + shards - 1) // shards
+        self.shards = [Cache(size=shardsize, age=age, policy=policy)
+                         for i in range(shards)]
+        self.locks = [threading.Lock() for i in range(shards)]
+
+    def _shard(self, key):
+        # scramble the hash so each shard's dict still sees varied low bits
+        i = ((hash(key) * 0x9E3779B1) >> 16) % len(self.shards)
+        return self.shards[i], self.locks[i]
+
+    def __getitem__(self, key):
+        shard, lock = self._shard(key)
+        lock.acquire()
+        try:
+            return shard[key]
+        finally:
+            lock.release()
+
+    def __setitem__(self, key, val):
+        shard, lock = self._shard(key)
+        lock.acquire()
+        try:
+            shard[key] = val
+        finally:
+            lock.release()
+
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        lock.acquire()
+        try:
+            del shard[key]
+        finally:
+            lock.release()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        shard, lock = self._shard(key)
+        lock.acquire()
+        try:
+            return shard.has_key(key)
+        finally:
+            lock.release()
+    __contains__ = has_key
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def keys(self):
+        result = []
+        for shard, lock in zip(self.shards, self.locks):
+            lock.acquire()
+            try:
+                result.extend(shard.keys())
+            finally:
+                lock.release()
+        return result
+
+    def update(self, dict):
+        for k in dict.keys():
+            self[k] = dict[k]
+
+    def purge_old_entries(self):
+        for shard, lock in zip(self.shards, self.locks):
+            lock.acquire()
+            try:
+                shard.purge_old_entries()
+            finally:
+                lock.release()
+
+    def clear(self):
+        for shard, lock in zip(self.shards, self.locks):
+            lock.acquire()
+            try:
+                shard.clear()
+            finally:
+                lock.release()
+
+    def stats(self):
+        """sum of the shards' stats"""
+        total = {}
+        for shard, lock in zip(self.shards, self.locks):
+            lock.acquire()
+            try:
+                for k, v in shard.stats().items():
+                    total[k] = total.get(k, 0) + v
+            finally:
+                lock.release()
+        return total
+
+class SharedCache(object):
+    """cache shared by forked processes through an anonymous shared mapping
+
+    Create it in the parent before forking the workers; they all then see
+    (and fill) the same entries.  The table is set associative: a key
+    hashes to a bucket of a few fixed-size slots, and when a bucket is full
+    its least recently fetched slot is reused.  Buckets are guarded by a
+    set of lock stripes.  Keys and values are pickled into the slots, so
+    they must be picklable and fit in slotsize bytes (less a small header)
+    together; keys are compared by their pickles, so stick to strings,
+    numbers and tuples of them.  Aging works as for Cache.
+    """
+    ways = 8
+    _counters = struct.Struct("=qqqq")     # hits, requests, inserts, unused
+    _header = struct.Struct("=IddHI")      # hash, mtime, ftime, klen, vlen
+
+    # age strings are parsed just as Cache does it
+    _apat = Cache.__dict__["_apat"]
+    _cvtage = Cache.__dict__["_cvtage"]
+
+    def __init__(self, size=10000, age=None, slotsize=256, stripes=64):
+        if isinstance(age, (str, unicode)):
+            age = self._cvtage(age)
+        self.age = age
+        self.slotsize = slotsize
+        self.buckets = max(1, (size + self.ways - 1) // self.ways)
+        self.size = self.buckets * self.ways
+        self.stripes = min(stripes, self.buckets)
+        self.locks = [multiprocessing.Lock() for i in range(self.stripes)]
+        self._base = self.stripes * self._counters.size
+        self.map = mmap.mmap(-1, self._base + self.size * slotsize)
+
+    def _locate(self, key):
+        """return key's pickle, hash, first slot offset and stripe"""
+        kb = cPickle.dumps(key, 2)
+        h = zlib.crc32(kb) & 0xffffffff
+        bucket = h % self.buckets
+        return (kb, h, self._base + bucket * self.ways * self.slotsize,
+                bucket % self.stripes)
+
+    def _find(self, kb, h, offset):
+        """return the offset of the slot holding kb (or None)"""
+        unpack = self._header.unpack_from
+        hsize = self._header.size
+        for i in range(self.ways):
+            sh, mtime, ftime, klen, vlen = unpack(self.map, offset)
+            if (klen == len(kb) and sh == h and
+                self.map[offset+hsize:offset+hsize+klen] == kb):
+                return offset
+            offset += self.slotsize
+        return None
+
+    def _count(self, stripe, hits=0, requests=0, inserts=0, unused=0):
+        offset = stripe * self._counters.size
+        counts = self._counters.unpack_from(self.map, offset)
+        self._counters.pack_into(self.map, offset, counts[0] + hits,
+                                 counts[1] + requests, counts[2] + inserts,
+                                 counts[3] + unused)
+
+    def __getitem__(self, key):
+        kb, h, offset, stripe = self._locate(key)
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            self._count(stripe, requests=1)
+            slot = self._find(kb, h, offset)
+            if slot is None:
+                raise KeyError(key)
+            sh, mtime, ftime, klen, vlen = self._header.unpack_from(self.map,
+                                                                    slot)
+            now = time.time()
+            if self.age is not None and now-self.age > mtime:
+                self._header.pack_into(self.map, slot, 0, 0.0, 0.0, 0, 0)
+                raise ExpiredError(key)
+            self._header.pack_into(self.map, slot, sh, mtime, now, klen, vlen)
+            start = slot + self._header.size + klen
+            data = self.map[start:start+vlen]
+            self._count(stripe, hits=1)
+        finally:
+            lock.release()
+        return cPickle.loads(data)
+
+    def __setitem__(self, key, val):
+        kb, h, offset, stripe = self._locate(key)
+        vb = cPickle.dumps(val, 2)
+        if self._header.size + len(kb) + len(vb) > self.slotsize:
+            raise ValueError("key and value need more than %d bytes" %
+                             self.slotsize)
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            slot = self._find(kb, h, offset)
+            if slot is None:
+                # use an empty slot, else the least recently fetched one
+                unpack = self._header.unpack_from
+                oldest = None
+                for i in range(self.ways):
+                    sh, mtime, ftime, klen, vlen = unpack(self.map, offset)
+                    if klen == 0:
+                        slot = offset
+                        break
+                    if oldest is None or ftime < oldest:
+                        slot, oldest, unused = offset, ftime, ftime == mtime
+                    offset += self.slotsize
+                else:
+                    self._count(stripe, unused=int(unused))
+            now = time.time()
+            self._header.pack_into(self.map, slot, h, now, now, len(kb),
+                                   len(vb))
+            start = slot + self._header.size
+            self.map[start:start+len(kb)+len(vb)] = kb + vb
+            self._count(stripe, inserts=1)
+        finally:
+            lock.release()
+
+    def __delitem__(self, key):
+        kb, h, offset, stripe = self._locate(key)
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            slot = self._find(kb, h, offset)
+            if slot is None:
+                raise KeyError(key)
+            self._header.pack_into(self.map, slot, 0, 0.0, 0.0, 0, 0)
+        finally:
+            lock.release()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        kb, h, offset, stripe = self._locate(key)
+        lock = self.locks[stripe]
+        lock.acquire()
+        try:
+            slot = self._find(kb, h, offset)
+            if slot is None:
+                return 0
+            mtime = self._header.unpack_from(self.map, slot)[1]
+        finally:
+            lock.release()
+        if self.age is not None and time.time()-self.age > mtime:
+            return 0
+        return 1
+    __contains__ = has_key
+
+    def _slots(self, bucket):
+        offset = self._base + bucket * self.ways * self.slotsize
+        return range(offset, offset + self.ways * self.slotsize, self.slotsize)
+
+    def __len__(self):
+        n = 0
+        for bucket in range(self.buckets):
+            for slot in self._slots(bucket):
+                if self._header.unpack_from(self.map, slot)[3]:
+                    n += 1
+        return n
+
+    def purge_old_entries(self):
+        """discard entries neither modified nor fetched in last age seconds"""
+        if self.age is None:
+            return
+        for stripe in range(self.stripes):
+            lock = self.locks[stripe]
+            lock.acquire()
+            try:
+                threshold = time.time() - self.age
+                unused = 0
+                for bucket in range(stripe, self.buckets, self.stripes):
+                    for slot in self._slots(bucket):
+                        (sh, mtime, ftime,
+                         klen, vlen) = self._header.unpack_from(self.map, slot)
+                        if klen and threshold > max(mtime, ftime):
+                            unused += ftime == mtime
+                            self._header.pack_into(self.map, slot,
+                                                   0, 0.0, 0.0, 0, 0)
+                self._count(stripe, unused=unused)
+            finally:
+                lock.release()
+
+    def stats(self):
+        """sum of the counters kept by each lock stripe"""
+        total = [0, 0, 0, 0]
+        for stripe in range(self.stripes):
+            lock = self.locks[stripe]
+            lock.acquire()
+            try:
+                counts = self._counters.unpack_from(self.map,
+                                                    stripe*self._counters.size)
+            finally:
+                lock.release()
+            total = map(operator.add, total, counts)
+        return dict(zip(('hits', 'requests', 'inserts', 'unused'), total))
+
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+_kwmark = (object(),)
+
+def _make_key(args, kw):
+    """build a hashable cache key from positional and keyword arguments"""
+    key = args
+    if kw:
+        key += _kwmark + tuple(sorted(kw.items()))
+    return key
+
+class _Call(object):
+    """a computation in progress which other threads can wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+def cached(size=100, age=None, policy=None):
+    """decorator which memoizes a function's results in a Cache
+
+    Arguments (positional and keyword) must be hashable.  If several threads
+    ask for the same uncached result at once, only the first calls the
+    function; the rest wait for and share its result (or exception).  The
+    wrapper grows cache_info() and cache_clear() methods and a cache
+    attribute holding the underlying Cache.
+    """
+    def decorate(func):
+        cache = Cache(size=size, age=age, policy=policy)
+        lock = threading.Lock()
+        calls = {}
+
+        def wrapper(*args, **kw):
+            key = _make_key(args, kw)
+            lock.acquire()
+            try:
+                try:
+                    return cache[key]
+                except KeyError:
+                    pass
+                call = calls.get(key)
+                leader = call is None
+                if leader:
+                    call = calls[key] = _Call()
+            finally:
+                lock.release()
+            if leader:
+                try:
+                    call.value = func(*args, **kw)
+                except:
+                    call.error = sys.exc_info()
+                lock.acquire()
+                try:
+                    if call.error is None:
+                        cache[key] = call.value
+                    del calls[key]
+                finally:
+                    lock.release()
+                call.done.set()
+            return call.result()
+
+        def cache_info():
+            lock.acquire()
+            try:
+                stats = cache.stats()
+                return CacheInfo(stats['hits'],
+                                 stats['requests'] - stats['hits'],
+                                 cache.size, len(cache))
+            finally:
+                lock.release()
+
+        def cache_clear():
+            lock.acquire()
+            try:
+                cache.clear()
+            finally:
+                lock.release()
+
+        wrapper = functools.wraps(func)(wrapper)
+        wrapper.cache = cache
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorate
+
+def _locked(method):
+    """wrap method so it runs holding the instance's lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kw):
+        self._lock.acquire()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            self._lock.release()
+    return wrapper
+
+class LoadingCache(Cache):
+    """Cache which computes missing values with a loader function
+
+    A lookup of a missing key calls loader(key) and caches the result.  A
+    lookup of an entry older than the age limit returns the stale value at
+    once and reloads it on a background thread, so callers don't wait for
+    the recomputation.  Only one load per key is ever in progress; other
+    threads asking for the same key wait for it.  Exceptions raised by the
+    loader propagate to waiting callers; a failed background reload leaves
+    the stale value in place.  All operations are serialized by a lock, so
+    a LoadingCache may be shared between threads.
+
+    Background reloads run on worker threads, started by the first one.
+    Call close() when done with the cache to stop them; the threads refer
+    to the cache, so it is never collected while they run.
+    """
+    def __init__(self,loader,data=None,size=100,age=None,policy=None,
+                 max_bytes=None,sizer=sys.getsizeof,workers=2):
+        Cache.__init__(self, data, size, age, policy, max_bytes, sizer)
+        self.loader = loader
+        self.workers = workers
+        self.stale = 0
+        self._lock = threading.RLock()
+        self._calls = {}
+        self._queue = None
+        self._threads = []
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            if self.age is not None and dict.__contains__(self, key):
+                mtime, ftime = self._times(key)
+                if time.time()-self.age > mtime:
+                    return self._get_stale(key)
+            try:
+                return Cache.__getitem__(self, key)
+            except KeyError:
+                pass
+            call, leader = self._call(key)
+        finally:
+            self._lock.release()
+        if leader:
+            self._load(key, call)
+        return call.result()
+
+    def __setitem__(self, key, val):
+        self._lock.acquire()
+        try:
+            Cache.__setitem__(self, key, val)
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            Cache.__delitem__(self, key)
+        finally:
+            self._lock.release()
+
+    def _get_stale(self, key):
+        """return key's expired value and schedule a reload (lock held)"""
+        self.requests += 1
+        self.hits += 1
+        self.stale += 1
+        val, mtime = self._fetch(key)
+        if self.policy is not None:
+            self.policy.access(key)
+        call, leader = self._call(key)
+        if leader:
+            if self._queue is None:
+                self._start_workers()
+            self._queue.put((key, call))
+        return val
+
+    def _call(self, key):
+        """return key's pending load and whether the caller must run it"""
+        call = self._calls.get(key)
+        if call is not None:
+            return call, False
+        call = self._calls[key] = _Call()
+        return call, True
+
+    def _load(self, key, call):
+        try:
+            call.value = self.loader(key)
+        except:
+            call.error = sys.exc_info()
+        self._lock.acquire()
+        try:
+            if call.error is None:
+                Cache.__setitem__(self, key, call.value)
+            del self._calls[key]
+        finally:
+            self._lock.release()
+        call.done.set()
+
+    def _start_workers(self):
+        self._queue = Queue.Queue()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, args=(self._queue,))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            key, call = item
+            self._load(key, call)
+
+    def close(self):
+        """finish any pending reloads and stop the worker threads"""
+        self._lock.acquire()
+        try:
+            queue, self._queue = self._queue, None
+            threads, self._threads = self._threads, []
+        finally:
+            self._lock.release()
+        if queue is not None:
+            for t in threads:
+                queue.put(None)
+            for t in threads:
+                t.join()
+
+    def stats(self):
+        stats = Cache.stats(self)
+        stats['stale'] = self.stale
+        return stats
+
+    def copy(self):
+        if self.policy is None:
+            policy = None
+        else:
+            policy = self.policy.__class__
+        return self.__class__(self.loader, self, self.size, self.age, policy,
+                              self.max_bytes, self.sizer, self.workers)
+
+    # the reload threads change entries, the expiry heap and the policy, so
+    # everything else which reads or writes them has to hold the lock too
+    # (fetch times are written by values() and items() as well)
+    stats = _locked(stats)
+    clear = _locked(Cache.clear)
+    shrink = _locked(Cache.shrink)
+    shrink_bytes = _locked(Cache.shrink_bytes)
+    purge_old_entries = _locked(Cache.purge_old_entries)
+    has_key = _locked(Cache.has_key)
+    values = _locked(Cache.values)
+    items = _locked(Cache.items)
+    ftimes = _locked(Cache.ftimes)
+    mtimes = _locked(Cache.mtimes)
+    snapshot = _locked(Cache.snapshot)
+
 def _test():
     print "testing cache overflow properties"
     c = Cache(size=100)
@@ -199,6 +1604,149 @@ def _test():
     x.sort()
     assert x == [1,5]+range(26,120), x
 
+    print "testing lru policy"
+    c = Cache(size=100, policy="lru")
+    for i in range(120):
+        c[i] = i
+        if i > 5:
+            x = c[5]
+    x = c.keys()
+    x.sort()
+    assert x == [5]+range(21,120), x
+    c.update({1:1})
+    x = c.keys()
+    x.sort()
+    assert x == [1,5]+range(26,120), x
+    assert c.unused == 25, c.unused
+    assert c.hits == c.requests == 114, c.stats()
+    del c[5]
+    c.clear()
+    assert len(c) == 0 and len(c.policy.order) == 0
+    try:
+        c = Cache(policy="random")
+    except ValueError:
+        c = None
+    assert c is None
+
+    print "testing pluggable policies"
+    for name in sorted(policies):
+        c = Cache(size=100, policy=name)
+        for i in range(50):
+            # a small popular set with scans of one-off keys mixed in
+            keys = ["hot%d" % j for j in range(20)] * 3
+            keys.extend(range(i*150, (i+1)*150))
+            for k in keys:
+                try:
+                    x = c[k]
+                except KeyError:
+                    c[k] = k
+            assert len(c) <= 100, (name, len(c))
+        if name in ("arc", "lfu", "tinylfu"):
+            # these should shrug off scans longer than the cache (2q only
+            # does when the hot keys recur before falling out of a1out)
+            assert c.hits > 2500, (name, c.stats())
+        c["hot0"] = 0
+        del c["hot0"]
+        x = c.policy.evict(len(c))
+        assert len(x) == len(c) and "hot0" not in x, name
+        c.clear()
+        assert not c.policy.evict(10)
+
+    print "testing overwrites keep policy history"
+    # (2q is left out - hits in its a1in fifo don't count by design)
+    for name in ("lru", "lfu", "arc", "tinylfu"):
+        c = Cache(size=10, policy=name)
+        c["hot"] = 0
+        for i in range(9):
+            c[i] = i
+        for i in range(9):
+            x = c[i]
+        for i in range(50):
+            x = c["hot"]
+        c["hot"] = 1
+        for i in range(10, 13):
+            c[i] = i
+        assert c["hot"] == 1, name
+
+    print "testing tinylfu admission"
+    # looping over more keys than fit flushes lru completely, while the
+    # sketch refuses to swap equally popular keys for each other
+    for name in ("lru", "tinylfu"):
+        c = Cache(size=100, policy=name)
+        for i in range(20):
+            for k in range(150):
+                try:
+                    x = c[k]
+                except KeyError:
+                    c[k] = k
+        if name == "lru":
+            assert c.hits == 0, c.stats()
+        else:
+            assert c.hits > 1000, c.stats()
+    c = Cache(size=100, policy="tinylfu")
+    calls = []
+    frequency = c.policy.sketch.frequency
+    c.policy.sketch.frequency = lambda key: calls.append(key) or frequency(key)
+    for k in range(300):
+        c[k] = k
+    assert calls, "sketch never consulted"
+
+    print "testing byte budget"
+    for p in (None, "lru"):
+        c = Cache(size=0, max_bytes=1000, sizer=len, policy=p)
+        for i in range(20):
+            c[i] = "x" * 100
+            if p is None:
+                time.sleep(0.01)
+        assert c.bytes <= 1000 and c.bytes == 100 * len(c), (p, c.bytes)
+        assert c.stats()['bytes'] == c.bytes
+        x = c.keys()
+        x.sort()
+        assert x == range(10, 20), (p, x)
+        c[19] = "x" * 10
+        assert c.bytes == 910, c.bytes
+        # a value bigger than the trim target is refused, without
+        # flushing the rest, and doesn't leave an older value behind
+        c[100] = "x" * 5000
+        assert c.bytes == 910 and len(c) == 10 and 100 not in c, c.bytes
+        c[19] = "x" * 5000
+        assert c.bytes == 900 and len(c) == 9 and 19 not in c, c.bytes
+        c.clear()
+        for i in range(5):
+            c[i] = "x" * 100
+        c[100] = "x" * 980
+        assert c.bytes == 500 and len(c) == 5 and 100 not in c, c.bytes
+        # one which fits after trimming only pushes out what it must
+        c[100] = "x" * 900
+        assert c.bytes == 900 and c.keys() == [100], c.keys()
+        c.clear()
+        c[1] = "x"
+        del c[1]
+        assert c.bytes == 0
+        c[1] = "x"
+        c.clear()
+        assert c.bytes == 0 and not c._sizes
+
+    print "testing compact storage"
+    for p in (None, "lru"):
+        c = CompactCache(size=100, policy=p)
+        for i in range(120):
+            c[i] = i
+            if i > 5:
+                x = c[5]
+            if p is None:
+                time.sleep(0.01)
+        x = c.keys()
+        x.sort()
+        assert x == [5]+range(21,120), x
+        assert len(c._values) == 100, len(c._values)
+        assert c[50] == 50 and c.get(7) is None
+        assert c.unused == 20, c.unused
+        c[50] = "fifty"
+        assert c[50] == "fifty" and len(c._values) == 100
+        c.clear()
+        assert len(c) == 0 and not c._values
+
     print "testing cache aging properties"
     c = Cache(age=3)
     for i in range(5):
@@ -256,6 +1804,270 @@ def _test():
     c[100] = 1
     c.purge_old_entries()
     assert len(c) == 1, len(c)
+    print "testing expiry heap"
+    c = Cache(size=0, age="100s")
+    for n in range(10):
+        c[n] = n
+    time.sleep(0.2)
+    for n in range(10, 20):
+        c[n] = n
+    x = c[3]
+    c.age = 0.1
+    c.purge_old_entries()
+    x = c.keys()
+    x.sort()
+    assert x == [3]+range(10, 20), x
+    assert len(c._expiry) == 11, len(c._expiry)
+    assert c.unused == 9, c.unused
+    c[10] = 10
+    c.clear()
+    assert not c._expiry
+    # stale pairs from evictions and overwrites don't pile up
+    c = Cache(size=100, age=3600, policy="lru")
+    for n in range(20000):
+        c[n] = n
+        c[n % 10] = n
+    assert len(c._expiry) <= 2 * len(c) + 100, len(c._expiry)
+    c.age = 0
+    c.purge_old_entries()
+    assert len(c) == 0, len(c)
+    print "testing instrumentation"
+    c = Cache(size=10, age=100, policy="lru")
+    x = c.snapshot()
+    assert 'latency' not in x and x['entries'] == 0, x
+    c.instrument()
+    for i in range(20):
+        c[i] = i
+        x = c.get(i)
+    x = c.get(100)
+    dict.__getitem__(c, 19).mtime -= 1000
+    x = c.get(19)
+    c.purge_old_entries()
+    x = c.snapshot()
+    assert x['evictions'] == {'size': 9, 'bytes': 0, 'age': 1}, x['evictions']
+    assert x['latency']['get']['count'] == 22, x['latency']['get']
+    assert x['latency']['set']['count'] == 20
+    assert x['latency']['shrink']['count'] == 9
+    assert x['latency']['purge']['count'] == 2
+    assert x['ages']['count'] == len(c) == 10
+    assert x['ages']['buckets'][0] == (1.0, 10), x['ages']['buckets'][0]
+    text = c.prometheus()
+    assert 'cache_evictions_total{reason="size"} 9\n' in text, text
+    assert 'cache_operation_seconds_bucket{op="get",le="+Inf"} 22\n' in text
+    assert 'cache_operation_seconds_count{op="get"} 22\n' in text
+    assert 'cache_hits_total 20\n' in text
+    c.instrument(False)
+    c[1] = 1
+    assert c.instruments is None
+    c = Cache(size=0, max_bytes=1000, sizer=len)
+    c[1] = "x" * 10
+    text = c.prometheus()
+    assert '# TYPE cache_bytes gauge\ncache_bytes 10\n' in text, text
+    assert 'bytes_total' not in text
+    assert '# TYPE cache_inserts_total counter\n' in text
+
+    print "testing persistent cache"
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, "cache.log")
+        c = PersistentCache(fn, size=100, age=100, policy="lru")
+        for k in ("a", "b", "old", "stale"):
+            c[k] = k.upper()
+        x = c["a"]
+        del c["b"]
+        t = time.time() - 1000
+        dict.__getitem__(c, "old").mtime = dict.__getitem__(c, "old").ftime = t
+        dict.__getitem__(c, "stale").mtime = t
+        times = c._times("a")
+        c.close()
+        c = PersistentCache(fn, size=100, age=100, policy="lru")
+        assert c._times("a") == times and times[0] != times[1]
+        x = c.keys()
+        x.sort()
+        assert x == ["a", "stale"], x
+        assert c["a"] == "A"
+        try:
+            x = c["stale"]
+        except ExpiredError:
+            x = None
+        assert x is None and "stale" not in c.keys()
+        # an unpicklable value is refused without being half added
+        try:
+            c["bad"] = threading.Lock()
+        except (TypeError, cPickle.PicklingError):
+            pass
+        else:
+            raise AssertionError("unpicklable value accepted")
+        assert "bad" not in c.keys() and c.get("bad") is None
+        try:
+            c.copy()
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("PersistentCache copied")
+        for i in range(200):
+            c[i] = i
+        assert len(c) <= 100
+        c.flush()
+        # a crash leaves the log unsynced, possibly with a torn last record
+        open(fn, "ab").write(cPickle.dumps(("s", "torn", 1, 0, 0), 2)[:-3])
+        c = PersistentCache(fn, size=100, age=100, policy="lru")
+        assert len(c) <= 100 and c[199] == 199 and "torn" not in c.keys()
+        c.clear()
+        c.close()
+        c = PersistentCache(fn)
+        assert len(c) == 0
+        c.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "testing sharded cache"
+    c = ShardedCache(shards=4, size=400, policy="lru")
+    def worker(n):
+        for i in range(2000):
+            k = (i * 7 + n) % 600
+            if c.get(k) is None:
+                c[k] = k
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    x = c.stats()
+    assert x['requests'] == 8 * 2000, x
+    assert x['hits'] + x['inserts'] == x['requests'], x
+    assert len(c) <= 400 and len(c.keys()) == len(c), len(c)
+    for shard in c.shards:
+        assert len(shard) <= 100, len(shard)
+    c[1000] = "x"
+    assert 1000 in c and c[1000] == "x"
+    del c[1000]
+    assert 1000 not in c
+    c.clear()
+    assert len(c) == 0
+    print "testing loading cache"
+    loads = []
+    def loader(key):
+        loads.append(key)
+        time.sleep(0.1)
+        if key < 0:
+            raise ValueError(key)
+        return (key, len(loads))
+    c = LoadingCache(loader, size=10, age=0.3)
+    assert c[1] == (1, 1) and c[1] == (1, 1) and loads == [1]
+    time.sleep(0.4)
+    t = time.time()
+    # stale values come back at once; only one reload is started
+    assert c[1] == (1, 1) and c[1] == (1, 1), c[1]
+    assert time.time() - t < 0.1
+    time.sleep(0.2)
+    assert c[1] == (1, 2) and loads == [1, 1], loads
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c[2]))
+                 for n in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [(2, 3)] * 5 and loads == [1, 1, 2], (results, loads)
+    try:
+        c[-1]
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("loader exception not propagated")
+    assert c.stats()['stale'] == 2, c.stats()
+    threads = threading.active_count()
+    c.close()
+    assert threading.active_count() == threads - c.workers
+    # workers start again if needed, and closing an idle cache is harmless
+    time.sleep(0.4)
+    assert c[1] == (1, 2) and c.stats()['stale'] == 3
+    c.close()
+    c.close()
+    assert threading.active_count() == threads - c.workers
+    # entries are only read and written with the lock held
+    c._lock.acquire()
+    done = []
+    t = threading.Thread(target=lambda: done.append(c.values()))
+    t.start()
+    t.join(0.2)
+    assert not done
+    c._lock.release()
+    t.join()
+    assert done
+    assert c[1] == (1, len(loads)) and c[1][1] > 2, loads
+    x = c.copy()
+    assert (x.loader, x.size, x.age, x.workers) == (loader, 10, 0.3, 2)
+    assert x[3] == (3, len(loads)), x[3]
+
+    print "testing shared cache"
+    c = SharedCache(size=64, age="100s", slotsize=128, stripes=4)
+    assert c.age == 100
+    def child():
+        for i in range(32):
+            c["k%d" % i] = (i, "v" * i)
+    p = multiprocessing.Process(target=child)
+    p.start()
+    p.join()
+    assert c["k5"] == (5, "vvvvv") and c.get("k40") is None
+    assert "k31" in c and "k40" not in c and len(c) == 32, len(c)
+    x = c.stats()
+    assert x == {'hits': 1, 'requests': 2, 'inserts': 32, 'unused': 0}, x
+    del c["k5"]
+    assert c.get("k5") is None and len(c) == 31
+    try:
+        c["big"] = "x" * 200
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("oversized entry accepted")
+    for i in range(1000):
+        c[i] = i
+    assert len(c) <= c.size == 64
+    assert c.stats()['unused'] > 900, c.stats()
+    c.age = 0.1
+    time.sleep(0.2)
+    try:
+        x = c[999]
+    except ExpiredError:
+        x = None
+    assert x is None
+    c.purge_old_entries()
+    assert len(c) == 0
+
+    print "testing cached decorator"
+    calls = []
+    @cached(size=10)
+    def slow(a, b=0):
+        calls.append((a, b))
+        time.sleep(0.2)
+        if a < 0:
+            raise ValueError(a)
+        return a + b
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow(1, b=2)))
+                 for n in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [3] * 10 and calls == [(1, 2)], (results, calls)
+    assert slow(1, b=2) == 3 and slow(1, 2) == 3 and slow(1) == 1
+    assert len(calls) == 3, calls
+    try:
+        slow(-1)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("exception not propagated")
+    x = slow.cache_info()
+    assert x.currsize == 3 and x.maxsize == 10, x
+    assert x.hits == 1 and x.misses == 13, x
+    assert slow.__name__ == "slow"
+    slow.cache_clear()
+    assert slow.cache_info().currsize == 0
     print "all cache tests passed"
 
 if __name__ == "__main__":
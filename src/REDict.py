@@ -39,10 +39,33 @@ as you don't delete the regular expression key from the dictionary, repeated
 probes of the dictionary for a given input key will map to the same actual
 key.
 
+The PriorityREDict class resolves such conflicts predictably: keys with a
+higher priority (set with d.set_priority(key, priority)) are tried first,
+then keys requiring more literal characters, so d['aaac'] == 'a-a-a-c'
+there.  All REDicts have a get_all(probe) method which returns every key
+the probe matches, in the order they are tried.
+
+To classify a large number of strings, use d.classify_many(probes) (or
+d.iclassify(probes) to generate the results as probes are read).  They
+look up each distinct probe in a batch once and can spread the work across
+a pool of processes.
+
+Building the key index for a large dictionary takes a while, so d.save(file)
+writes the index along with the keys and values.  load(file) reads them
+back without repeating the work.
+
 Note: Regular expressions are only used when probing an REDict.  For
 setting, deleting or popping elements from an REDict, normal dictionary
 behavior is used.
 
+Probes don't try the keys one at a time.  The first probe after the set of
+keys changes indexes the keys by the literal text they require (the
+".python.org" in '.*\.python\.org', the "www.foo." in 'www\.foo\..*'), so a
+probe is only matched against the keys whose literal it contains.  Keys
+without such a literal are compiled into a few large alternations (one per
+90 keys, since sre allows only 100 groups in a pattern).  When several keys
+match, the one earliest in d.keys() wins.
+
 Note: In theory, you can also work things the other way.  The keys can be
 constant strings and the dictionary probed using a regular expression.  It's
 less obvious that the semantics of such an arrangement behave as much like
@@ -66,54 +89,455 @@ end, I think you're stuck with the slow but safe choice:
             if re.match(key, candidate):
                 return candidate
 
+The PatternQueryDict class avoids most of that search.  Its keys are plain
+strings and d.get_all(pattern) returns those which pattern matches.  It
+keeps its keys sorted and indexed by their three character substrings, so
+it only has to try the keys which contain the literal text (like "www." in
+'www\..*\.org') the pattern requires.
+
 The FastREDict class is also much faster than the REDict class.  Once a
 match for a specific input key is found, the same match is reused as long as
 that match remains a key in the underlying dictionary.  For largely static
 dictionaries which are probed many times using the same keys this can speed
-up access tremendously.  Try executing this module as a standalone script
+up access tremendously.  Only the size (default 10000) most recently used
+probes are remembered, so memory use stays bounded no matter how many
+distinct probes are seen.  Try executing this module as a standalone script
 and give it the -t flag (uses the timeit module, so this feature is
-available only in Python 2.3 or later).
+available only in Python 2.3 or later).  The redictbench.py script measures
+how the classes scale with the number and kind of keys.
 """
 
 import re
+import sre_parse
+import sre_constants
 import sys
+import os
+import gc
+import itertools
+import bisect
+import marshal
+import cPickle
+import multiprocessing
+from collections import OrderedDict
 
 _VERB = False
 
-__all__ = ["REDict", "FastREDict"]
+# keys per combined pattern - sre allows at most 100 groups per pattern
+_CHUNK = 90
+
+__all__ = ["REDict", "FastREDict", "PriorityREDict", "PatternQueryDict",
+           "load"]
+
+def _literal_runs(pattern):
+    """return [(literal, start), ...] for the literal runs pattern requires.
+
+    Only the top level of the parsed pattern is examined, since everything
+    there must match (repeats and alternations are single items).  start
+    is 0 when the literal is a prefix of every string pattern matches.
+    """
+    parsed = sre_parse.parse(pattern)
+    if parsed.pattern.flags:
+        # the literals might match case-insensitively, etc.
+        return []
+    if isinstance(pattern, unicode):
+        char = unichr
+    else:
+        char = chr
+    runs = []
+    run = []
+    for i, (op, av) in enumerate(list(parsed) + [(None, None)]):
+        if op == sre_constants.LITERAL:
+            run.append(char(av))
+        elif run:
+            runs.append(("".join(run), i - len(run)))
+            run = []
+    return runs
+
+def _literal_run(key):
+    """return (literal, start) for the longest literal run key requires.
+
+    Returns (None, 0) if key has no usable literal.
+    """
+    best = None, 0
+    for literal, start in _literal_runs(key):
+        if best[0] is None or len(literal) > len(best[0]):
+            best = literal, start
+    return best
+
+def _literal_count(key):
+    """return the number of literal characters key requires"""
+    parsed = sre_parse.parse(key)
+    if parsed.pattern.flags:
+        return 0
+    return len([op for op, av in parsed if op == sre_constants.LITERAL])
+
+def _trie_add(trie, literal, i):
+    node = trie
+    for c in literal:
+        node = node.setdefault(c, {})
+    # None can't be a character, so it marks the keys ending here
+    node.setdefault(None, []).append(i)
+
+def _trie_walk(trie, probe, start, found):
+    """add to found the keys whose literal appears in probe at start"""
+    node = trie
+    for i in xrange(start, len(probe)):
+        node = node.get(probe[i])
+        if node is None:
+            return
+        if None in node:
+            found.update(node[None])
+
+class _KeyIndex(object):
+    """literal index over the keys of an REDict.
+
+    Most keys contain a literal every matching string must contain, e.g.
+    ".python.org" in r".*\.python\.org".  Those literals are kept in two
+    tries, one for literals which must start the probe and one for those
+    which may appear anywhere, so a probe only needs to be matched against
+    the keys whose literal it contains.  Finding them costs a walk from
+    each position of the probe, independent of the number of keys.
+
+    Keys with no usable literal are checked every time.  Runs of them are
+    each wrapped in a group and joined into one alternation, so a single
+    match tells us (via lastindex) which key succeeded.  sre allows at
+    most 100 groups per pattern, so long runs are split into chunks.  Keys
+    with groups of their own (joining would renumber them) or inline flags
+    (they would apply to the whole alternation) are compiled on their own.
+
+    Of the keys which match, the one earliest in keys is returned.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.patterns = [None] * len(keys)
+        self.prefixes = {}
+        self.literals = {}
+        # [(pattern source, [key indexes])] in key order
+        self.unindexed = []
+        run = []
+        for i, k in enumerate(keys):
+            literal, start = _literal_run(k)
+            if literal is not None:
+                if start == 0:
+                    _trie_add(self.prefixes, literal, i)
+                else:
+                    _trie_add(self.literals, literal, i)
+                continue
+            pattern = sre_parse.parse(k).pattern
+            if pattern.groups > 1 or pattern.flags:
+                self._chunks(run)
+                run = []
+                self.unindexed.append((k, [i]))
+            else:
+                run.append(i)
+        self._chunks(run)
+        self.compiled = [None] * len(self.unindexed)
+
+    def _chunks(self, run):
+        """join runs of plain keys into alternations of at most _CHUNK"""
+        keys = self.keys
+        for i in range(0, len(run), _CHUNK):
+            chunk = run[i:i+_CHUNK]
+            self.unindexed.append(("|".join(["(%s)" % keys[j]
+                                             for j in chunk]),
+                                   chunk))
+
+    def dumps(self):
+        """return the index as a string, less the compiled patterns"""
+        return marshal.dumps((self.keys, self.prefixes, self.literals,
+                              self.unindexed))
+
+    def candidates(self, probe):
+        """return the indexes of the keys whose literal probe contains"""
+        found = set()
+        _trie_walk(self.prefixes, probe, 0, found)
+        literals = self.literals
+        if literals:
+            for start, c in enumerate(probe):
+                if c in literals:
+                    _trie_walk(literals, probe, start, found)
+        return found
+
+    # patterns are only compiled when first needed, which keeps building
+    # (or loading) an index cheap
+
+    def _pattern(self, i):
+        pat = self.patterns[i]
+        if pat is None:
+            pat = self.patterns[i] = re.compile(self.keys[i])
+        return pat
+
+    def _unindexed(self, j):
+        pat = self.compiled[j]
+        if pat is None:
+            pat = self.compiled[j] = re.compile(self.unindexed[j][0])
+        return pat
+
+    def find(self, probe):
+        """return the earliest key which matches probe, or None"""
+        best = None
+        for i in sorted(self.candidates(probe)):
+            if self._pattern(i).match(probe) is not None:
+                best = i
+                break
+        for j, (source, chunk) in enumerate(self.unindexed):
+            if best is not None and chunk[0] > best:
+                break
+            mat = self._unindexed(j).match(probe)
+            if mat is not None:
+                if len(chunk) == 1:
+                    i = chunk[0]
+                else:
+                    i = chunk[mat.lastindex-1]
+                if best is None or i < best:
+                    best = i
+                break
+        if best is None:
+            return None
+        return self.keys[best]
+
+    def find_all(self, probe):
+        """return every key which matches probe, earliest first"""
+        found = [i for i in self.candidates(probe)
+                   if self._pattern(i).match(probe) is not None]
+        for j, (source, chunk) in enumerate(self.unindexed):
+            # one match rules out the whole chunk in the common case
+            if self._unindexed(j).match(probe) is not None:
+                if len(chunk) == 1:
+                    found.append(chunk[0])
+                else:
+                    found.extend([i for i in chunk
+                                    if self._pattern(i).match(probe)
+                                       is not None])
+        found.sort()
+        return [self.keys[i] for i in found]
+
+def _load_index(data):
+    """return a _KeyIndex restored from a _KeyIndex.dumps() string"""
+    index = _KeyIndex.__new__(_KeyIndex)
+    # the tries are lots of small dicts, which would otherwise trigger
+    # several pointless garbage collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        (index.keys, index.prefixes, index.literals,
+         index.unindexed) = marshal.loads(data)
+    finally:
+        if enabled:
+            gc.enable()
+    index.patterns = [None] * len(index.keys)
+    index.compiled = [None] * len(index.unindexed)
+    return index
+
+def load(filename):
+    """return the REDict (or subclass) saved in filename.
+
+    The key index isn't rebuilt.  It is restored when first probed and its
+    patterns are compiled as they are needed, so a large dictionary can
+    answer probes almost as soon as it is loaded.
+    """
+    f = open(filename, "rb")
+    try:
+        d = cPickle.load(f)
+        d._snapshot = f.read()
+    finally:
+        f.close()
+    return d
+
+# the key index of a classify pool worker
+_worker_index = None
+
+def _init_worker(keys):
+    global _worker_index
+    _worker_index = _KeyIndex(keys)
+
+def _worker_find(probes):
+    find = _worker_index.find
+    return [find(probe) for probe in probes]
 
-class REDict(dict):
+class _StringDict(dict):
+    """A dictionary with string keys which keeps an index of them.
+
+    Subclasses build the index when they need it and discard it in
+    _invalidate, which is called whenever the set of keys changes.
+    """
+
+    def _invalidate(self):
+        pass
+
+    def __setitem__(self, key, value):
+        """Set an item in the dictionary.
+
+        Note that we don't use regular expressions here!
+        """
+        if not isinstance(key, (str, unicode)):
+            raise TypeError, "%s is not a string type" % key
+        if not dict.__contains__(self, key):
+            self._invalidate()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        """Delete an item from the dictionary.
+
+        Note that regular expressions aren't used here!
+        """
+        if not isinstance(key, (str, unicode)):
+            raise TypeError, "%s is not a string type" % key
+        dict.__delitem__(self, key)
+        self._invalidate()
+
+    # the remaining mutators bypass __setitem__ and __delitem__ so must
+    # invalidate the index themselves
+
+    def clear(self):
+        dict.clear(self)
+        self._invalidate()
+
+    def pop(self, *args):
+        self._invalidate()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._invalidate()
+        return dict.popitem(self)
+
+    def setdefault(self, key, fail=None):
+        if not dict.__contains__(self, key):
+            self[key] = fail
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwds):
+        self._invalidate()
+        dict.update(self, *args, **kwds)
+
+class REDict(_StringDict):
     """A dictionary whose keys are regular expressions."""
 
+    # index over the keys, built lazily by the first probe after the set of
+    # keys changes
+    _index = None
+    # the dumped index read by load(), restored by the first probe
+    _snapshot = None
+
     def _get_exact_key(self, key):
         """return an actual key which re matches the input key"""
-        keys = self.keys()
-        while len(keys) > 1:
-            # minimize the number of matches necessary by using binary search
-            mid = len(keys)/2
-            if _VERB: print >> sys.stderr, (key, mid, keys[:mid], keys[mid:]),
-            lowkeys = keys[0:mid]
-            if lowkeys and re.match('|'.join(lowkeys), key) is not None:
-                if _VERB: print >> sys.stderr, "l",
-                keys = lowkeys
+        k = self._get_index().find(key)
+        if _VERB: print >> sys.stderr, (key, k)
+        if k is None:
+            raise KeyError, "%s does not re match any actual key" % key
+        return k
+
+    def _get_index(self):
+        if self._index is None:
+            if self._snapshot is not None:
+                self._index = _load_index(self._snapshot)
+                self._snapshot = None
             else:
-                highkeys = keys[mid:]
-                if re.match('|'.join(highkeys), key) is not None:
-                    if _VERB: print >> sys.stderr, "h",
-                    keys = highkeys
-                else:
-                    if _VERB: print >> sys.stderr, "f",
-                    keys = []
-        if keys:
-            if _VERB: print >> sys.stderr, keys[0]
-            return keys[0]
-        if _VERB: print >> sys.stderr
-        raise KeyError, "%s does not re match any actual key" % key
+                self._index = _KeyIndex(self._ordered_keys())
+        return self._index
+
+    def _ordered_keys(self):
+        """return the keys in the order they are tried"""
+        return self.keys()
+
+    def _invalidate(self):
+        self._index = self._snapshot = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_index", None)
+        state.pop("_snapshot", None)
+        return state
+
+    def save(self, filename):
+        """save the dictionary and its key index to filename.
+
+        Use load(filename) to get it back.  The values must be picklable.
+        """
+        tmp = "%s.tmp" % filename
+        f = open(tmp, "wb")
+        try:
+            cPickle.dump(self, f, 2)
+            f.write(self._get_index().dumps())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def classify_many(self, probes, fail=None, keys=False, processes=None):
+        """return a list of the values probes match (fail if none).
+
+        See iclassify for the details.
+        """
+        return list(self.iclassify(probes, fail, keys, processes=processes))
+
+    def iclassify(self, probes, fail=None, keys=False, batch=10000,
+                  processes=None):
+        """generate the value each of probes matches (fail if none).
+
+        If keys is true, generate the matching actual keys instead.
+        probes are read batch at a time and each distinct probe in a batch
+        is only looked up once.  If processes is given, lookups are spread
+        across a pool of that many processes, each with its own copy of
+        the keys as they were when iclassify was called.  That only pays
+        for large batches of mostly distinct probes.
+        """
+        pool = None
+        if processes:
+            pool = multiprocessing.Pool(processes, _init_worker,
+                                        (self._ordered_keys(),))
+        try:
+            probes = iter(probes)
+            while True:
+                chunk = list(itertools.islice(probes, batch))
+                if not chunk:
+                    break
+                for result in self._classify(chunk, fail, keys, pool,
+                                             processes):
+                    yield result
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _classify(self, chunk, fail, keys, pool, processes):
+        unique = dict.fromkeys(chunk).keys()
+        if pool is None:
+            find = self._get_index().find
+            found = [find(probe) for probe in unique]
+        else:
+            n = len(unique) // (processes * 4) + 1
+            found = []
+            for part in pool.imap(_worker_find,
+                                  [unique[i:i+n]
+                                     for i in range(0, len(unique), n)]):
+                found.extend(part)
+        matches = dict(zip(unique, found))
+        result = []
+        for probe in chunk:
+            k = matches[probe]
+            if k is None:
+                result.append(fail)
+            elif keys:
+                result.append(k)
+            else:
+                result.append(dict.__getitem__(self, k))
+        return result
+
+    def get_all(self, key):
+        """return every actual key which re matches the input key.
+
+        The keys are listed in the order probes try them, so the first
+        (if any) is the one d[key] would use.
+        """
+        return self._get_index().find_all(key)
 
     def get(self, key, fail=None):
-        if key in self:
+        try:
             return self[key]
-        else:
+        except KeyError:
             return fail
 
     def has_key_exact(self, key):
@@ -138,23 +562,125 @@ class REDict(dict):
         k = self._get_exact_key(key)
         return dict.__getitem__(self, k)
 
-    def __setitem__(self, key, value):
-        """Set an item in the dictionary.
+class PriorityREDict(REDict):
+    """A version of REDict which resolves multiple matches predictably.
 
-        Note that we don't use regular expressions here!
-        """
-        if not isinstance(key, (str, unicode)):
-            raise TypeError, "%s is not a string type" % key
-        dict.__setitem__(self, key, value)
+    Keys are tried in order of their priority (highest first, default 0),
+    then the number of literal characters they require (most first, so
+    'www\.python\.org' beats '.*\.python\.org'), then the keys
+    themselves.
+    """
+    def __init__(self, *args, **kwds):
+        REDict.__init__(self, *args, **kwds)
+        self._priorities = {}
+
+    def _ordered_keys(self):
+        priorities = self._priorities
+        ranked = [(-priorities.get(k, 0), -_literal_count(k), k)
+                    for k in self.keys()]
+        ranked.sort()
+        return [k for p, n, k in ranked]
+
+    def set_priority(self, key, priority):
+        """set the priority of the actual key"""
+        if not dict.__contains__(self, key):
+            raise KeyError, key
+        self._priorities[key] = priority
+        self._invalidate()
+
+    def get_priority(self, key):
+        """return the priority of the actual key"""
+        if not dict.__contains__(self, key):
+            raise KeyError, key
+        return self._priorities.get(key, 0)
 
     def __delitem__(self, key):
-        """Delete an item from an REDict.
+        REDict.__delitem__(self, key)
+        self._priorities.pop(key, None)
 
-        Note that regular expressions aren't used here!
-        """
-        if not isinstance(key, (str, unicode)):
-            raise TypeError, "%s is not a string type" % key
-        dict.__delitem__(self, key)
+    def clear(self):
+        REDict.clear(self)
+        self._priorities.clear()
+
+    def pop(self, key, *args):
+        value = REDict.pop(self, key, *args)
+        self._priorities.pop(key, None)
+        return value
+
+    def popitem(self):
+        key, value = REDict.popitem(self)
+        self._priorities.pop(key, None)
+        return key, value
+
+class PatternQueryDict(_StringDict):
+    """A dictionary with plain string keys which can be queried with
+    regular expressions - REDict turned around.
+
+    d.get_all(pattern) returns the keys pattern re matches.  The keys are
+    kept sorted, so a pattern starting with literal text is only tried
+    against the keys with that prefix.  They are also indexed by the three
+    character substrings they contain, so a pattern requiring literal text
+    elsewhere is only tried against the keys which contain all of its
+    three character substrings.  Other patterns have to be tried against
+    every key.
+    """
+
+    # the sorted keys and a map from each three character substring to the
+    # set of keys containing it, built by the first query needing them
+    # after the set of keys changes
+    _sorted = None
+    _trigrams = None
+
+    def _invalidate(self):
+        self._sorted = self._trigrams = None
+
+    def _get_sorted(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.keys())
+        return self._sorted
+
+    def _get_trigrams(self):
+        if self._trigrams is None:
+            trigrams = {}
+            for k in self.keys():
+                for i in range(len(k) - 2):
+                    trigrams.setdefault(k[i:i+3], set()).add(k)
+            self._trigrams = trigrams
+        return self._trigrams
+
+    def _candidates(self, pattern):
+        """return the sorted keys pattern might match"""
+        runs = _literal_runs(pattern)
+        keys = None
+        if runs and runs[0][1] == 0:
+            prefix = runs[0][0]
+            ordered = self._get_sorted()
+            lo = hi = bisect.bisect_left(ordered, prefix)
+            while hi < len(ordered) and ordered[hi].startswith(prefix):
+                hi += 1
+            keys = ordered[lo:hi]
+        grams = set()
+        for literal, start in runs:
+            for i in range(len(literal) - 2):
+                grams.add(literal[i:i+3])
+        if grams and (keys is None or len(keys) > len(grams)):
+            trigrams = self._get_trigrams()
+            sets = [trigrams.get(g, ()) for g in grams]
+            sets.sort(key=len)
+            found = set(sets[0]).intersection(*sets[1:])
+            if keys is None:
+                keys = sorted(found)
+            else:
+                keys = [k for k in keys if k in found]
+        if keys is None:
+            keys = self._get_sorted()
+        return keys
+
+    def get_all(self, pattern):
+        """return the keys pattern re matches, in sorted order"""
+        match = re.compile(pattern).match
+        return [k for k in self._candidates(pattern)
+                  if match(k) is not None]
 
 class SlowREDict(REDict):
     """A version of REDict which uses linear search.
@@ -171,26 +697,64 @@ class SlowREDict(REDict):
         raise KeyError, "%s does not re match any actual key" % key
 
 class FastREDict(REDict):
-    """A version of REDict which remembers what specific keys matched."""
-    def __init__(self, *args):
-        REDict.__init__(self, *args)
-        self._cache = {}
+    """A version of REDict which remembers what specific keys matched.
+
+    At most size probes are remembered, the least recently used being
+    forgotten first.  A size of 0 (or less) remembers nothing.
+    """
+    def __init__(self, *args, **kwds):
+        self._size = kwds.pop("size", 10000)
+        REDict.__init__(self, *args, **kwds)
+        # probe -> actual key, in least to most recently used order
+        self._cache = OrderedDict()
+        # actual key -> set of probes it resolved
+        self._probes = {}
         self.true_counts = self.counts = 0
 
     def _get_exact_key(self, key):
-        self.true_counts += int(key in self._cache)
         self.counts += 1
-        if key in self._cache:
-            return self._cache[key]
+        cache = self._cache
+        if key in cache:
+            self.true_counts += 1
+            k = cache.pop(key)
+            cache[key] = k
+            return k
         k = REDict._get_exact_key(self, key)
-        self._cache[key] = k
+        if self._size <= 0:
+            return k
+        if len(cache) >= self._size:
+            probe, old = cache.popitem(last=False)
+            probes = self._probes[old]
+            probes.discard(probe)
+            if not probes:
+                del self._probes[old]
+        cache[key] = k
+        self._probes.setdefault(k, set()).add(key)
         return k
 
+    def _forget(self, key):
+        """drop remembered matches for the actual key"""
+        for probe in self._probes.pop(key, ()):
+            del self._cache[probe]
+
     def __delitem__(self, key):
         REDict.__delitem__(self, key)
-        delkeys = [k for k in self._cache if self._cache[k] == key]
-        for k in delkeys:
-            del self._cache[k]
+        self._forget(key)
+
+    def clear(self):
+        REDict.clear(self)
+        self._cache.clear()
+        self._probes.clear()
+
+    def pop(self, key, *args):
+        value = REDict.pop(self, key, *args)
+        self._forget(key)
+        return value
+
+    def popitem(self):
+        key, value = REDict.popitem(self)
+        self._forget(key)
+        return key, value
 
     def __del__(self):
         if _VERB:
@@ -273,6 +837,104 @@ if __name__ == "__main__":
             self.assertFalse("d" in d)
             self.assertTrue("bc" in d)
 
+        def test_many_keys(self):
+            d = self.new_dict()
+            for i in range(1000):
+                d["k%d$" % i] = i
+            self.assertEqual(d.get("k0"), 0)
+            self.assertEqual(d.get("k537"), 537)
+            self.assertEqual(d.get("k999"), 999)
+            self.assertEqual(d.get("k1000"), None)
+
+        def test_groups_and_flags(self):
+            d = self.new_dict()
+            d["abc"] = "abc"
+            d["(x+)y\\1$"] = "backref"
+            d["(?i)q+"] = "ignorecase"
+            d["a|b+d"] = "alternation"
+            self.assertEqual(d.get("xxyxx"), "backref")
+            self.assertEqual(d.get("xxyx"), None)
+            self.assertEqual(d.get("QQ"), "ignorecase")
+            self.assertEqual(d.get("ABC"), None)
+            self.assertEqual(d.get("bbd"), "alternation")
+
+        def test_mutation(self):
+            d = self.new_dict()
+            d["abc"] = "abc"
+            self.assertEqual(d.get("xyz"), None)
+            d.update({"x.z": "x.z"})
+            self.assertEqual(d.get("xyz"), "x.z")
+            d.pop("x.z")
+            self.assertEqual(d.get("xyz"), None)
+            d.setdefault("xy+z", "xy+z")
+            self.assertEqual(d.get("xyyz"), "xy+z")
+            d.clear()
+            self.assertEqual(d.get("abc"), None)
+
+        def test_literal_index(self):
+            d = self.new_dict()
+            for i in range(100):
+                for k in (r".*\.site%d\.org$" % i, r"www\.dom%d\..*" % i,
+                          r"[a-z]+%d" % i):
+                    d[k] = k
+            for probe in ("a.site17.org", "b.a.site99.org", "a.site17.orgx",
+                          "www.dom5.com", "www.dom5", "abc12", "12", ""):
+                matches = [k for k in d.keys() if re.match(k, probe)]
+                found = d.get_all(probe)
+                self.assertEqual(sorted(found), sorted(matches))
+                self.assertEqual(d.get(probe), (found or [None])[0])
+            index = _KeyIndex(d.keys())
+            self.assertEqual(sorted([index.keys[i] for i in
+                                     index.candidates("x.site7.org")]),
+                             [r".*\.site7\.org$", r"[a-z]+7"])
+
+        def test_get_all(self):
+            d = self.new_dict()
+            d["abc"] = "abc"
+            d["ab+c"] = "ab+c"
+            d["(a)*b+c"] = "(a)*b+c"
+            d["b+c"] = "b+c"
+            self.assertEqual(d.get_all("d"), [])
+            self.assertEqual(sorted(d.get_all("abc")),
+                             ["(a)*b+c", "ab+c", "abc"])
+            self.assertEqual(d.get_all("abc")[0], d._get_exact_key("abc"))
+            self.assertEqual(sorted(d.get_all("bbc")), ["(a)*b+c", "b+c"])
+
+        def test_classify(self):
+            d = self.new_dict()
+            d["a+$"] = "a"
+            d["b+$"] = "b"
+            probes = ["a", "b", "c", "aaa", "a", "bb", "c"] * 10
+            expected = ["a", "b", None, "a", "a", "b", None] * 10
+            self.assertEqual(d.classify_many(probes), expected)
+            self.assertEqual(list(d.iclassify(iter(probes), "-", batch=3)),
+                             [x or "-" for x in expected])
+            self.assertEqual(d.classify_many(probes[:7], keys=True),
+                             ["a+$", "b+$", None, "a+$", "a+$", "b+$", None])
+            self.assertEqual(d.classify_many(probes, processes=2), expected)
+            self.assertEqual(d.classify_many([]), [])
+
+        def test_save_load(self):
+            import tempfile
+            d = self.new_dict()
+            for k in ("a+$", r".*\.foo\.org", "[xy]+z", "(q)\\1"):
+                d[k] = k.upper()
+            fname = tempfile.mktemp()
+            try:
+                d.save(fname)
+                e = load(fname)
+            finally:
+                os.unlink(fname)
+            self.assertEqual(type(e), type(d))
+            self.assertEqual(dict(e), dict(d))
+            self.assertFalse(e._snapshot is None)
+            for probe in ("aa", "w.foo.org", "xyz", "qq", "q", "b"):
+                self.assertEqual(e.get(probe), d.get(probe))
+                self.assertEqual(e.get_all(probe), d.get_all(probe))
+            self.assertTrue(e._snapshot is None)
+            e["b"] = "B"
+            self.assertEqual(e.get("b"), "B")
+
         def test_set(self):
             d = self.new_dict()
             self.assertRaises(TypeError, d.__setitem__, 1, "1")
@@ -282,10 +944,102 @@ if __name__ == "__main__":
         def new_dict(self):
             return SlowREDict()
 
+    class PriorityREDictTests(REDictTests):
+        def new_dict(self):
+            return PriorityREDict()
+
+        def test_priority(self):
+            import tempfile
+            d = PriorityREDict()
+            d["a+c"] = "a-plus-c"
+            d["aaac"] = "a-a-a-c"
+            d["a.*"] = "a-dot-star"
+            self.assertEqual(d["aaac"], "a-a-a-c")
+            self.assertEqual(d.get_all("aaac"), ["aaac", "a+c", "a.*"])
+            d.set_priority("a.*", 1)
+            self.assertEqual(d.get_priority("a.*"), 1)
+            self.assertEqual(d["aaac"], "a-dot-star")
+            self.assertEqual(d.get_all("aaac"), ["a.*", "aaac", "a+c"])
+            self.assertRaises(KeyError, d.set_priority, "b", 1)
+            fname = tempfile.mktemp()
+            try:
+                d.save(fname)
+                e = load(fname)
+            finally:
+                os.unlink(fname)
+            self.assertEqual(e.get_priority("a.*"), 1)
+            self.assertEqual(e.get_all("aaac"), ["a.*", "aaac", "a+c"])
+            del d["a.*"]
+            self.assertEqual(d._priorities, {})
+            self.assertEqual(d["aaac"], "a-a-a-c")
+
+        def test_tie_break(self):
+            d = PriorityREDict()
+            for k in ("b.*", "a.*", ".*"):
+                d[k] = k
+            self.assertEqual(d.get_all("ab"), ["a.*", ".*"])
+            self.assertEqual(d.get_all("bb"), ["b.*", ".*"])
+
+    class PatternQueryDictTests(unittest.TestCase):
+        def test_get_all(self):
+            d = PatternQueryDict()
+            for i in range(200):
+                d["www.site%d.org" % i] = i
+                d["mail.site%d.com" % i] = i
+            d["ww"] = 0
+            for pattern in (r"www\.site1\d\.", r"www\.site1\d\.", r".*e17\.",
+                            r"mail\.site19\.com$", r".+\.com", r"(?i)WW+",
+                            r"w", r"x.*", r"[a-z]+1[0-9]\.org", ""):
+                matches = sorted([k for k in d if re.match(pattern, k)])
+                self.assertEqual(d.get_all(pattern), matches)
+            self.assertEqual(len(d._candidates(r".*\.site17\.")), 2)
+            self.assertEqual(len(d._candidates(r"www\.site17\.")), 1)
+
+        def test_mutation(self):
+            d = PatternQueryDict()
+            d["abc"] = 1
+            self.assertEqual(d.get_all("ab"), ["abc"])
+            self.assertEqual(d.get_all(".*bcd"), [])
+            d["abcd"] = 2
+            self.assertEqual(d.get_all("ab"), ["abc", "abcd"])
+            self.assertEqual(d.get_all(".*bcd"), ["abcd"])
+            del d["abc"]
+            self.assertEqual(d.get_all("ab"), ["abcd"])
+            d.clear()
+            self.assertEqual(d.get_all("ab"), [])
+            self.assertRaises(TypeError, d.__setitem__, 1, 1)
+
     class FastREDictTests(REDictTests):
         def new_dict(self):
             return FastREDict()
 
+        def test_bounded_memo(self):
+            d = FastREDict(size=3)
+            d["a+"] = "a+"
+            d["b+"] = "b+"
+            for n in range(1, 6):
+                self.assertEqual(d["a" * n], "a+")
+            self.assertEqual(len(d._cache), 3)
+            self.assertEqual(sorted(d._cache), ["aaa", "aaaa", "aaaaa"])
+            d["aaa"]
+            d["b"]
+            self.assertEqual(sorted(d._cache), ["aaa", "aaaaa", "b"])
+            self.assertEqual(d._probes, {"a+": set(["aaa", "aaaaa"]),
+                                         "b+": set(["b"])})
+            del d["a+"]
+            self.assertEqual(d._cache.keys(), ["b"])
+            self.assertEqual(d._probes, {"b+": set(["b"])})
+            self.assertEqual(d.get("aaa"), None)
+
+        def test_no_memo(self):
+            d = FastREDict(size=0)
+            d["a+"] = "a+"
+            self.assertEqual(d.get("aaa"), "a+")
+            self.assertEqual(d["aaa"], "a+")
+            self.assertEqual(d.get("b"), None)
+            self.assertEqual(len(d._cache), 0)
+            self.assertEqual(d._probes, {})
+
     if do_timing:
         import timeit
         setup = """\
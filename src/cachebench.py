@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Benchmark Cache.Cache eviction policies against synthetic workloads or
+recorded key traces.  For each workload and policy report the hit ratio,
+throughput, median and 99th percentile request latency and the peak
+resident set size.
+
+Usage: %(PROG)s [ options ] [ tracefile ... ]
+    -s size - cache size in entries (default 1000)
+    -p p1,p2,... - policies to compare (default: all, plus "ftime", the
+                   original sort-by-fetch-time trimming)
+    -w w1,w2,... - synthetic workloads to run: zipf, scan and/or loop
+    -n count - requests per synthetic workload (default 100000)
+    -k count - distinct keys in synthetic workloads (default 10 * size)
+    -a alpha - zipf skew (default 1.0)
+    -r seed - random seed for synthetic workloads (default 0)
+    -o file - save the results (as JSON) to file
+    -c file - compare the results with those saved in file
+    -m n - instead of running workloads, compare the memory used per entry
+           by Cache and CompactCache holding n (fetched) entries
+  The trace files contain one key per line.  If neither workloads nor trace
+  files are given the trace is read from stdin.  Each request is a lookup;
+  misses insert the key.
+
+  The workloads are:
+    zipf - keys drawn from a zipf distribution
+    scan - zipf traffic interrupted every 10 * size requests by a
+           sequential scan of 2 * size keys never seen before
+    loop - keys requested in order, over and over
+"""
+
+import sys
+import getopt
+import os
+import time
+import resource
+import marshal
+import random
+import bisect
+import array
+import json
+
+import Cache
+
+PROG = os.path.split(sys.argv[0])[1]
+
+def usage(msg=None):
+    if msg is not None:
+        print >> sys.stderr, msg
+        print >> sys.stderr
+    print >> sys.stderr, (__doc__.strip() % globals())
+
+def read_trace(files):
+    keys = []
+    for f in files:
+        for line in f:
+            keys.append(line.rstrip("\r\n"))
+    return keys
+
+def zipf_keys(n, keyspace, alpha, rng):
+    total = 0.0
+    cumulative = []
+    for rank in range(1, keyspace+1):
+        total += 1.0 / rank ** alpha
+        cumulative.append(total)
+    return [bisect.bisect_left(cumulative, rng.random() * total)
+              for i in range(n)]
+
+def scan_keys(n, keyspace, alpha, rng, size):
+    keys = zipf_keys(n, keyspace, alpha, rng)
+    result = []
+    fresh = keyspace
+    for start in range(0, n, 10 * size):
+        result.extend(keys[start:start + 10 * size])
+        result.extend(range(fresh, fresh + 2 * size))
+        fresh += 2 * size
+    return result[:n]
+
+def loop_keys(n, keyspace):
+    return [i % keyspace for i in range(n)]
+
+def workload(name, n, keyspace, alpha, seed, size):
+    rng = random.Random(seed)
+    if name == "zipf":
+        return zipf_keys(n, keyspace, alpha, rng)
+    if name == "scan":
+        return scan_keys(n, keyspace, alpha, rng, size)
+    if name == "loop":
+        return loop_keys(n, keyspace)
+    raise ValueError("unknown workload: %s" % name)
+
+def replay(keys, size, policy):
+    """feed keys through a new cache, return a dictionary of results"""
+    c = Cache.Cache(size=size, policy=policy)
+    latencies = array.array("d", [0.0]) * len(keys)
+    clock = time.time
+    i = 0
+    start = clock()
+    for key in keys:
+        t = clock()
+        try:
+            c[key]
+        except KeyError:
+            c[key] = 1
+        latencies[i] = clock() - t
+        i += 1
+    elapsed = clock() - start
+    if not keys:
+        return {'hit': 0.0, 'throughput': 0.0, 'p50': 0.0, 'p99': 0.0}
+    latencies = sorted(latencies)
+    return {
+        'hit': float(c.hits) / c.requests,
+        'throughput': len(keys) / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+        }
+
+def maxrss():
+    """peak resident set size in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+def in_child(func, *args):
+    """run func(*args) in a forked child and return its (marshalable) result
+
+    Each measurement starts from the same heap and has its own peak RSS.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        os.write(wfd, marshal.dumps(func(*args)))
+        os._exit(0)
+    os.close(wfd)
+    chunks = []
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break
+        chunks.append(data)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return marshal.loads("".join(chunks))
+
+def measure(keys, size, policy):
+    result = replay(keys, size, policy)
+    result['rss'] = maxrss()
+    return result
+
+def entry_bytes(cls, n):
+    """bytes per entry of a cls instance holding n entries"""
+    keys = range(n)
+    before = maxrss()
+    c = cls(size=0)
+    for k in keys:
+        c[k] = None
+    # fetched entries carry a separate fetch time
+    for k in keys:
+        c[k]
+    return float(maxrss() - before) / n
+
+def memory(n):
+    print "%d entries" % n
+    print "%-14s %12s" % ("layout", "bytes/entry")
+    for cls in (Cache.Cache, Cache.CompactCache):
+        print "%-14s %12.1f" % (cls.__name__, in_child(entry_bytes, cls, n))
+
+def change(new, old):
+    if not old:
+        return ""
+    return "%+.0f%%" % ((new - old) * 100.0 / old)
+
+def report(results, previous):
+    """print results, with percentage changes from previous if given"""
+    old = {}
+    for r in previous:
+        old[(r['workload'], r['policy'])] = r
+    print "%-10s %-8s %7s %9s %8s %8s %8s" % ("workload", "policy", "hit%",
+                                              "kops/s", "p50 us", "p99 us",
+                                              "rss MB"),
+    if previous:
+        print "  %6s %6s %6s" % ("hit", "kops/s", "p99"),
+    print
+    for r in results:
+        print "%-10s %-8s %7.2f %9.1f %8.2f %8.2f %8.1f" % \
+              (r['workload'], r['policy'], r['hit'] * 100,
+               r['throughput'] / 1000, r['p50'] * 1e6, r['p99'] * 1e6,
+               r['rss'] / 1048576.0),
+        if previous:
+            o = old.get((r['workload'], r['policy']), {})
+            print "  %6s %6s %6s" % (change(r['hit'], o.get('hit')),
+                                     change(r['throughput'],
+                                            o.get('throughput')),
+                                     change(r['p99'], o.get('p99'))),
+        print
+
+def main(args):
+    size = 1000
+    names = ["ftime"] + sorted(Cache.policies)
+    workloads = []
+    n = 100000
+    keyspace = None
+    alpha = 1.0
+    seed = 0
+    output = None
+    previous = []
+
+    try:
+        opts, args = getopt.getopt(args, "s:p:w:n:k:a:r:o:c:m:h")
+    except getopt.GetoptError, msg:
+        usage(msg)
+        return 1
+
+    for opt, arg in opts:
+        if opt == "-s":
+            size = int(arg)
+        elif opt == "-p":
+            names = arg.split(",")
+        elif opt == "-w":
+            workloads = arg.split(",")
+        elif opt == "-n":
+            n = int(arg)
+        elif opt == "-k":
+            keyspace = int(arg)
+        elif opt == "-a":
+            alpha = float(arg)
+        elif opt == "-r":
+            seed = int(arg)
+        elif opt == "-o":
+            output = arg
+        elif opt == "-c":
+            previous = json.load(open(arg))
+        elif opt == "-m":
+            memory(int(arg))
+            return 0
+        elif opt == "-h":
+            usage()
+            return 0
+
+    for name in names:
+        if name != "ftime" and name not in Cache.policies:
+            usage("unknown policy: %s" % name)
+            return 1
+    for name in workloads:
+        if name not in ("zipf", "scan", "loop"):
+            usage("unknown workload: %s" % name)
+            return 1
+    if keyspace is None:
+        keyspace = 10 * size
+
+    traces = []
+    for name in workloads:
+        traces.append((name, workload(name, n, keyspace, alpha, seed, size)))
+    for f in args:
+        traces.append((os.path.basename(f), read_trace([open(f)])))
+    if not traces:
+        traces.append(("stdin", read_trace([sys.stdin])))
+
+    results = []
+    for wname, keys in traces:
+        for name in names:
+            if name == "ftime":
+                policy = None
+            else:
+                policy = name
+            r = in_child(measure, keys, size, policy)
+            r['workload'] = wname
+            r['policy'] = name
+            r['size'] = size
+            r['requests'] = len(keys)
+            results.append(r)
+
+    print "cache size %d" % size
+    report(results, previous)
+    if output is not None:
+        json.dump(results, open(output, "w"), indent=1)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Measure how CSV.load_parallel scales with the number of processes.  For a
+CSV file (one is generated if none is given) report the time taken by
+CSV.load and by CSV.load_parallel with each number of processes, its
+throughput and its speedup over load_parallel with one process.
+
+Usage: %(PROG)s [ options ] [ csvfile ]
+    -p p1,p2,... - process counts (default 1,2,4,... up to twice the
+                   number of CPUs)
+    -n count - rows in the generated file (default 200000)
+    -c size - chunk size in bytes (default 4194304)
+    -t - the file has a line of titles
+    -N - convert numbers
+    -r count - repeat each measurement and keep the fastest (default 3)
+
+  The speedup is less than linear even with a CPU per process.  The
+  workers parse the rows, but this process still has to turn them into
+  Entry's, which takes about a ninth as long as parsing, so the speedup
+  can't pass about nine.
+"""
+
+import sys
+import getopt
+import os
+import time
+import random
+import tempfile
+import multiprocessing
+
+import CSV
+
+PROG = os.path.split(sys.argv[0])[1]
+
+def usage(msg=None):
+    if msg is not None:
+        print >> sys.stderr, msg
+        print >> sys.stderr
+    print >> sys.stderr, (__doc__.strip() % globals())
+
+def make_file(filename, n, rng):
+    """write a CSV file of n rows, some with quoted fields, plus titles"""
+    f = open(filename, "w")
+    f.write("name,count,price,note\n")
+    for i in range(n):
+        if rng.random() < 0.2:
+            note = '"%d, ""quoted"""' % rng.randrange(1000)
+        else:
+            note = "plain %d" % rng.randrange(1000)
+        f.write("item%d,%d,%.2f,%s\n" % (i, rng.randrange(100),
+                                          rng.random() * 100, note))
+    f.close()
+
+def measure(load, repeat):
+    """return the fastest of repeat calls to load, in seconds"""
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        load()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(args):
+    cpus = multiprocessing.cpu_count()
+    counts = []
+    p = 1
+    while p <= 2 * cpus:
+        counts.append(p)
+        p = p * 2
+    n = 200000
+    chunk_size = 4194304
+    titles = 0
+    convert = 0
+    repeat = 3
+
+    try:
+        opts, args = getopt.getopt(args, "p:n:c:tNr:h")
+    except getopt.GetoptError, msg:
+        usage(msg)
+        return 1
+
+    for opt, arg in opts:
+        if opt == "-p":
+            counts = [int(p) for p in arg.split(",")]
+        elif opt == "-n":
+            n = int(arg)
+        elif opt == "-c":
+            chunk_size = int(arg)
+        elif opt == "-t":
+            titles = 1
+        elif opt == "-N":
+            convert = 1
+        elif opt == "-r":
+            repeat = int(arg)
+        elif opt == "-h":
+            usage()
+            return 0
+
+    if len(args) > 1:
+        usage("at most one file")
+        return 1
+    if args:
+        filename = args[0]
+        generated = False
+    else:
+        filename = tempfile.mktemp(".csv")
+        make_file(filename, n, random.Random(0))
+        titles = 1
+        generated = True
+
+    try:
+        size = os.path.getsize(filename)
+        c = CSV.CSV()
+        print "%s: %.1f MB, %d CPUs" % (filename, size / 1048576.0, cpus)
+        print "%-16s %9s %8s %8s" % ("loader", "seconds", "MB/s", "speedup")
+        t = measure(lambda: c.load(filename, titles, convert), repeat)
+        print "%-16s %9.3f %8.1f %8s" % ("load", t, size / 1048576.0 / t, "")
+        sys.stdout.flush()
+        base = None
+        for p in counts:
+            t = measure(lambda: c.load_parallel(filename, titles, convert,
+                                                processes=p,
+                                                chunk_size=chunk_size),
+                        repeat)
+            if base is None:
+                base = t
+            print "%-16s %9.3f %8.1f %8.2f" % ("parallel %d" % p, t,
+                                                size / 1048576.0 / t,
+                                                base / t)
+            sys.stdout.flush()
+    finally:
+        if generated:
+            os.unlink(filename)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
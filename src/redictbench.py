@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Measure how REDict lookups scale with the number and kind of keys and the
+fraction of probes which match.  For each combination and REDict class
+report the time taken by the first probe (which builds the key index) and
+the average time per probe after that.
+
+Usage: %(PROG)s [ options ]
+    -n n1,n2,... - key counts (default 10,100,1000,10000,100000)
+    -k k1,k2,... - kinds of keys (default all): literal, host, class
+    -r r1,r2,... - fractions of probes which match a key (default 0.9)
+    -c c1,c2,... - classes to compare (default REDict, FastREDict,
+                   PriorityREDict and SlowREDict)
+    -p count - probes per measurement (default 2000)
+    -d count - distinct probes (default 1000)
+    -s count - skip SlowREDict above this many keys (default 100)
+    -C - print CSV instead of a table
+
+  The kinds of keys are:
+    literal - plain numbers anchored at the end, like '12$', so a probe
+              such as '123' doesn't match a shorter key
+    host - hostname routes like '.*\.site12\.org$' and 'www\.dom12\..*'
+    class - keys made of character classes, which have no literal text
+            to index, like '[k_][1_][2_]$'
+"""
+
+import sys
+import getopt
+import os
+import time
+import random
+import csv
+
+import REDict
+
+PROG = os.path.split(sys.argv[0])[1]
+
+KINDS = ("literal", "host", "class")
+
+def usage(msg=None):
+    if msg is not None:
+        print >> sys.stderr, msg
+        print >> sys.stderr
+    print >> sys.stderr, (__doc__.strip() % globals())
+
+def make_keys(kind, n):
+    """return n keys of kind and a function returning a probe for key i"""
+    if kind == "literal":
+        keys = ["%d$" % i for i in range(n)]
+        probe = str
+    elif kind == "host":
+        keys = []
+        for i in range(0, n, 2):
+            keys.append(r".*\.site%d\.org$" % i)
+            keys.append(r"www\.dom%d\..*" % (i + 1))
+        keys = keys[:n]
+        def probe(i):
+            if i % 2:
+                return "www.dom%d.com" % i
+            return "mail.site%d.org" % i
+    elif kind == "class":
+        keys = ["".join(["[%s_]" % c for c in "k%d" % i]) + "$"
+                  for i in range(n)]
+        probe = lambda i: "k%d" % i
+    else:
+        raise ValueError("unknown kind: %s" % kind)
+    return keys, probe
+
+def make_probes(n, probe, count, distinct, ratio, rng):
+    """return count probes drawn from distinct strings, ratio of them hits"""
+    pool = []
+    for j in range(distinct):
+        if rng.random() < ratio:
+            pool.append(probe(rng.randrange(n)))
+        else:
+            # keys only go up to n - 1
+            pool.append(probe(n + rng.randrange(n)))
+    return [rng.choice(pool) for j in range(count)]
+
+def measure(cls, keys, probes):
+    """return (build seconds, seconds per probe) for a cls holding keys"""
+    d = cls()
+    for k in keys:
+        d[k] = k
+    t = time.time()
+    d.get(probes[0])
+    build = time.time() - t
+    get = d.get
+    t = time.time()
+    for p in probes:
+        get(p)
+    return build, (time.time() - t) / len(probes)
+
+def main(args):
+    counts = [10, 100, 1000, 10000, 100000]
+    kinds = list(KINDS)
+    ratios = [0.9]
+    names = ["REDict", "FastREDict", "PriorityREDict", "SlowREDict"]
+    count = 2000
+    distinct = 1000
+    slowmax = 100
+    as_csv = False
+
+    try:
+        opts, args = getopt.getopt(args, "n:k:r:c:p:d:s:Ch")
+    except getopt.GetoptError, msg:
+        usage(msg)
+        return 1
+
+    for opt, arg in opts:
+        if opt == "-n":
+            counts = [int(n) for n in arg.split(",")]
+        elif opt == "-k":
+            kinds = arg.split(",")
+        elif opt == "-r":
+            ratios = [float(r) for r in arg.split(",")]
+        elif opt == "-c":
+            names = arg.split(",")
+        elif opt == "-p":
+            count = int(arg)
+        elif opt == "-d":
+            distinct = int(arg)
+        elif opt == "-s":
+            slowmax = int(arg)
+        elif opt == "-C":
+            as_csv = True
+        elif opt == "-h":
+            usage()
+            return 0
+
+    for kind in kinds:
+        if kind not in KINDS:
+            usage("unknown kind: %s" % kind)
+            return 1
+    classes = []
+    for name in names:
+        cls = getattr(REDict, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, REDict.REDict)):
+            usage("unknown class: %s" % name)
+            return 1
+        classes.append(cls)
+
+    fields = ["keys", "kind", "hit", "class", "build ms", "us/probe"]
+    if as_csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fields)
+    else:
+        print "%8s %-8s %5s %-15s %10s %10s" % tuple(fields)
+
+    rng = random.Random(0)
+    for kind in kinds:
+        for n in counts:
+            keys, probe = make_keys(kind, n)
+            for ratio in ratios:
+                probes = make_probes(n, probe, count, distinct, ratio, rng)
+                for cls in classes:
+                    if cls is REDict.SlowREDict and n > slowmax:
+                        continue
+                    build, per = measure(cls, keys, probes)
+                    row = (n, kind, ratio, cls.__name__, build * 1e3,
+                           per * 1e6)
+                    if as_csv:
+                        writer.writerow(["%d" % n, kind, "%g" % ratio,
+                                         cls.__name__, "%.3f" % row[4],
+                                         "%.3f" % row[5]])
+                    else:
+                        print "%8d %-8s %5.2f %-15s %10.2f %10.2f" % row
+                    sys.stdout.flush()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))